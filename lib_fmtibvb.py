@@ -1,151 +1,130 @@
 # A small library of functions to read and write .fmt / .ib / .vb files into and out of
-# python structures that are JSON serializable.
+# python structures that are JSON serializable.  Vertex and index buffers are read as numpy
+# arrays (see columnar meshes below), the legacy list form can be obtained with mesh_to_legacy().
 #
 # GitHub eArmada8/gust_stuff
 
-import io, re, struct, json
+import io, re, struct, json, collections, functools, sys, numpy
 
-# Currently only simple formats (8-, 16-, and 32-bit) are supported.  Floats must be 32-bit.
-# Attempting to read an unsupported format will return a raw bytes object.
-def unpack_dxgi_vector(f, stride, dxgi_format, e = '<'):
+# Parsed DXGI format, e.g. R32G32B32_FLOAT is numtype 'FLOAT' with 3 elements of 32 bits (stride 12).  struct_code,
+# structs (struct.Struct by byte order) and numpy_code are None for formats that are handled as raw bytes;
+# gltf_component_type is the componentType the format is exported to glTF as.
+DXGIFormat = collections.namedtuple('DXGIFormat', ['format', 'numtype', 'elements', 'bits', 'stride',
+    'struct_code', 'structs', 'numpy_code', 'gltf_component_type'])
+
+# Formats are parsed once, and the descriptors are shared from then on
+@functools.lru_cache(maxsize = None)
+def get_dxgi_format(dxgi_format):
+    struct_codes = {'FLOAT': {32: 'f', 16: 'e'}, 'UINT': {32: 'I', 16: 'H', 8: 'B'},
+        'SINT': {32: 'i', 16: 'h', 8: 'b'}, 'UNORM': {32: 'I', 16: 'H', 8: 'B'},
+        'SNORM': {32: 'i', 16: 'h', 8: 'b'}}
+    gltf_component_types = {'FLOAT': 5126, 'UNORM': 5126, 'SNORM': 5126, 'UINT': {32: 5125, 16: 5123, 8: 5121}}
     dxgi_format = dxgi_format.split('DXGI_FORMAT_')[-1]
     dxgi_format_split = dxgi_format.split('_')
+    numtype, vec_elements, vec_bits, stride = 'UNSUPPORTED', 0, 0, False
     if len(dxgi_format_split) == 2:
         numtype = dxgi_format_split[1]
         vec_format = re.findall("[0-9]+",dxgi_format_split[0])
         if len(vec_format) > 0:
             vec_bits = int(vec_format[0])
             vec_elements = len(vec_format)
-        else:
-            vec_bits = 0
-            vec_elements = 0
+            stride = int(vec_elements * vec_bits / 8)
+    struct_code = struct_codes.get(numtype, {}).get(vec_bits, None)
+    if struct_code is not None:
+        structs = {x: struct.Struct(x + str(vec_elements) + struct_code) for x in '@=<>!'}
+        numpy_code = numpy.dtype(struct_code).str[1:]
     else:
-        numtype = 'UNSUPPORTED'
-
-    if numtype == 'FLOAT' and (vec_elements * vec_bits / 8 == stride):
-        if vec_bits == 32:
-            read = list(struct.unpack(e+str(vec_elements)+"f", f.read(stride)))
-        elif vec_bits == 16:
-            read = list(struct.unpack(e+str(vec_elements)+"e", f.read(stride)))
-    elif numtype == 'UINT' and (vec_elements * vec_bits / 8 == stride):
-        if vec_bits == 32:
-            read = list(struct.unpack(e+str(vec_elements)+"I", f.read(stride)))
-        elif vec_bits == 16:
-            read = list(struct.unpack(e+str(vec_elements)+"H", f.read(stride)))
-        elif vec_bits == 8:
-            read = list(struct.unpack(e+str(vec_elements)+"B", f.read(stride)))
-    elif numtype == "SINT" and (vec_elements * vec_bits / 8 == stride):
-        if vec_bits == 32:
-            read = list(struct.unpack(e+str(vec_elements)+"i", f.read(stride)))
-        elif vec_bits == 16:
-            read = list(struct.unpack(e+str(vec_elements)+"h", f.read(stride)))
-        elif vec_bits == 8:
-            read = list(struct.unpack(e+str(vec_elements)+"b", f.read(stride)))
-    elif numtype == "UNORM" and (vec_elements * vec_bits / 8 == stride):
-        # First read as integers
-        if vec_bits == 32:
-            read = list(struct.unpack(e+str(vec_elements)+"I", f.read(stride)))
-        elif vec_bits == 16:
-            read = list(struct.unpack(e+str(vec_elements)+"H", f.read(stride)))
-        elif vec_bits == 8:
-            read = list(struct.unpack(e+str(vec_elements)+"B", f.read(stride)))
-        # Convert to normalized floats
-        float_max = ((2**vec_bits)-1)
-        for i in range(len(read)):
-            read[i] = read[i] / float_max
-    elif numtype == "SNORM" and (vec_elements * vec_bits / 8 == stride):
-        # First read as integers
-        if vec_bits == 32:
-            read = list(struct.unpack(e+str(vec_elements)+"i", f.read(stride)))
-        elif vec_bits == 16:
-            read = list(struct.unpack(e+str(vec_elements)+"h", f.read(stride)))
-        elif vec_bits == 8:
-            read = list(struct.unpack(e+str(vec_elements)+"b", f.read(stride)))
-        # Convert to normalized floats
-        float_max = ((2**(vec_bits-1))-1)
-        for i in range(len(read)):
-            read[i] = read[i] / float_max
+        structs, numpy_code = None, None
+    gltf_component_type = gltf_component_types.get(numtype, None)
+    if isinstance(gltf_component_type, dict):
+        gltf_component_type = gltf_component_type.get(vec_bits, None)
+    return(DXGIFormat(dxgi_format, numtype, vec_elements, vec_bits, stride,
+        struct_code, structs, numpy_code, gltf_component_type))
+
+# Descriptor of dxgi_format (a string or a DXGIFormat) if it can be packed / unpacked into stride bytes,
+# otherwise None, in which case it is read and written as raw bytes.
+def get_vector_format(dxgi_format, stride):
+    if not isinstance(dxgi_format, DXGIFormat):
+        dxgi_format = get_dxgi_format(dxgi_format)
+    if dxgi_format.struct_code is not None and (dxgi_format.elements * dxgi_format.bits / 8 == stride):
+        return(dxgi_format)
     else:
-        read = f.read(stride)
+        return(None)
+
+# Currently only simple formats (8-, 16-, and 32-bit) are supported.  Floats must be 16- or 32-bit.
+# Attempting to read an unsupported format will return a raw bytes object.
+def unpack_dxgi_vector(f, stride, dxgi_format, e = '<'):
+    vector_format = get_vector_format(dxgi_format, stride)
+    if vector_format is None:
+        return(f.read(stride))
+    read = list(vector_format.structs[e].unpack(f.read(stride)))
+    # Convert to normalized floats
+    if vector_format.numtype == "UNORM":
+        float_max = ((2**vector_format.bits)-1)
+        read = [x / float_max for x in read]
+    elif vector_format.numtype == "SNORM":
+        float_max = ((2**(vector_format.bits-1))-1)
+        read = [x / float_max for x in read]
     return (read)
 
 def pack_dxgi_vector(f, data, stride, dxgi_format, e = '<'):
-    dxgi_format = dxgi_format.split('DXGI_FORMAT_')[-1]
-    dxgi_format_split = dxgi_format.split('_')
-    if len(dxgi_format_split) == 2:
-        numtype = dxgi_format_split[1]
-        vec_format = re.findall("[0-9]+",dxgi_format_split[0])
-        if len(vec_format) > 0:
-            vec_bits = int(vec_format[0])
-            vec_elements = len(vec_format)
-        else:
-            vec_bits = 0
-            vec_elements = 0
-    else:
-        numtype = 'UNSUPPORTED'
-
-    if numtype == 'FLOAT' and (vec_elements * vec_bits / 8 == stride):
-        for i in range(vec_elements):
-            if vec_bits == 32:
-                f.write(struct.pack(e+"f", data[i]))
-            elif vec_bits == 16:
-                f.write(struct.pack(e+"e", data[i]))
-    elif numtype == 'UINT' and (vec_elements * vec_bits / 8 == stride):
-        for i in range(vec_elements):
-            if vec_bits == 32:
-                f.write(struct.pack(e+"I", data[i]))
-            elif vec_bits == 16:
-                f.write(struct.pack(e+"H", data[i]))
-            elif vec_bits == 8:
-                f.write(struct.pack(e+"B", data[i]))
-    elif numtype == "SINT" and (vec_elements * vec_bits / 8 == stride):
-        for i in range(vec_elements):
-            if vec_bits == 32:
-                f.write(struct.pack(e+"i", data[i]))
-            elif vec_bits == 16:
-                f.write(struct.pack(e+"h", data[i]))
-            elif vec_bits == 8:
-                f.write(struct.pack(e+"b", data[i]))
-    elif numtype == 'UNORM' and (vec_elements * vec_bits / 8 == stride):
-        converted_data = []
-        for i in range(vec_elements):
-            #First convert back to unsigned integers, then pack
-            float_max = ((2**vec_bits)-1)
-            converted_data.append(int(round(min(max(data[i],0), 1) * float_max)))
-            if vec_bits == 32:
-                f.write(struct.pack(e+"I", converted_data[i]))
-            elif vec_bits == 16:
-                f.write(struct.pack(e+"H", converted_data[i]))
-            elif vec_bits == 8:
-                f.write(struct.pack(e+"B", converted_data[i]))
-    elif numtype == 'SNORM' and (vec_elements * vec_bits / 8 == stride):
-        converted_data = []
-        for i in range(vec_elements):
-            #First convert back to unsigned integers, then pack
-            float_max = ((2**(vec_bits-1))-1)
-            converted_data.append(int(round(min(max(data[i],-1), 1) * float_max)))
-            if vec_bits == 32:
-                f.write(struct.pack(e+"i", converted_data[i]))
-            elif vec_bits == 16:
-                f.write(struct.pack(e+"h", converted_data[i]))
-            elif vec_bits == 8:
-                f.write(struct.pack(e+"b", converted_data[i]))
-    else:
-        write = f.write(data)
+    vector_format = get_vector_format(dxgi_format, stride)
+    if vector_format is None:
+        f.write(data)
+        return
+    data = data[0:vector_format.elements]
+    #First convert back to integers, then pack
+    if vector_format.numtype == 'UNORM':
+        float_max = ((2**vector_format.bits)-1)
+        data = [int(round(min(max(x,0), 1) * float_max)) for x in data]
+    elif vector_format.numtype == 'SNORM':
+        float_max = ((2**(vector_format.bits-1))-1)
+        data = [int(round(min(max(x,-1), 1) * float_max)) for x in data]
+    f.write(vector_format.structs[e].pack(*data))
     return
 
 def get_stride_from_dxgi_format(dxgi_format):
-    dxgi_format = dxgi_format.split('DXGI_FORMAT_')[-1]
-    dxgi_format_split = dxgi_format.split('_')
-    if len(dxgi_format_split) == 2:
-        numtype = dxgi_format_split[1]
-        vec_format = re.findall("[0-9]+",dxgi_format_split[0])
-        if len(vec_format) > 0:
-            return(int(len(vec_format) * int(vec_format[0]) / 8))
-        else:
-            return False
-    else:
-        return False
+    if not isinstance(dxgi_format, DXGIFormat):
+        dxgi_format = get_dxgi_format(dxgi_format)
+    return(dxgi_format.stride)
+
+# Columnar meshes:  A mesh is {'fmt': fmt_struct, 'vb': vb_data, 'ib': ib_data}, where each element of vb_data
+# has its "Buffer" as a numpy array of shape (vertices, components) and ib_data is an array of shape (triangles, 3).
+# The legacy form uses lists of lists instead.  The write functions accept either form.
+def vb_to_columnar(vb_data):
+    columnar_vb = []
+    for element in vb_data:
+        element = dict(element)
+        if len(element["Buffer"]) == 0 or not isinstance(element["Buffer"][0], bytes): # Unsupported formats stay raw
+            element["Buffer"] = numpy.asarray(element["Buffer"])
+        columnar_vb.append(element)
+    return(columnar_vb)
+
+def vb_to_legacy(vb_data):
+    legacy_vb = []
+    for element in vb_data:
+        element = dict(element)
+        if isinstance(element["Buffer"], numpy.ndarray):
+            element["Buffer"] = element["Buffer"].tolist()
+        legacy_vb.append(element)
+    return(legacy_vb)
+
+def ib_to_columnar(ib_data):
+    if len(ib_data) > 0 and type(ib_data[0]) == list:
+        ib_data = [x for y in ib_data for x in y]
+    ib_data = numpy.asarray(ib_data, dtype = numpy.int64).reshape(-1)
+    return(ib_data.reshape(-1, 3) if len(ib_data) % 3 == 0 else ib_data)
+
+def ib_to_legacy(ib_data):
+    if isinstance(ib_data, numpy.ndarray):
+        ib_data = ib_data.tolist()
+    return(ib_data)
+
+def mesh_to_columnar(mesh):
+    return({**mesh, 'vb': vb_to_columnar(mesh['vb']), 'ib': ib_to_columnar(mesh['ib'])})
+
+def mesh_to_legacy(mesh):
+    return({**mesh, 'vb': vb_to_legacy(mesh['vb']), 'ib': ib_to_legacy(mesh['ib'])})
 
 def read_fmt(fmt_filename):
     fmt_struct = {}
@@ -189,21 +168,27 @@ def write_fmt(fmt_struct, fmt_filename):
     return
 
 def read_ib_stream(ib_stream, fmt_struct, e = '<'):
-    ib_data = []
     # Cheating a bit here, since all index buffers I've seen are single numbers, but fmt doesn't have a stride for IB
-    ib_stride = int(int(re.findall("[0-9]+", fmt_struct["format"])[0])/8)
+    ib_format = get_dxgi_format(fmt_struct["format"])
+    ib_stride = int(ib_format.bits/8)
+    if get_vector_format(ib_format, ib_stride) is not None and ib_format.numtype in ['UINT', 'SINT']:
+        # Whole buffer in one call, returned as an (N,3) triangle view when it divides evenly
+        ib_data = numpy.frombuffer(ib_stream, dtype = e + ib_format.numpy_code, count = len(ib_stream) // ib_stride)
+        ib_data = ib_data.astype(numpy.int64)
+        return(ib_data.reshape(-1, 3) if len(ib_data) % 3 == 0 else ib_data)
+    ib_data = []
     with io.BytesIO(ib_stream) as f:
         length = f.seek(0,2)
         f.seek(0)
         vertex_num = 0
         triangle = []
         while f.tell() < length:
-            triangle.extend(unpack_dxgi_vector(f, ib_stride, fmt_struct["format"], e))
+            triangle.extend(unpack_dxgi_vector(f, ib_stride, ib_format, e))
             vertex_num += 1
             if vertex_num % 3 == 0 or f.tell() == length:
                 ib_data.append(triangle)
                 triangle = []
-    return(ib_data)
+    return(ib_to_columnar(ib_data))
 
 def read_ib(ib_filename, fmt_struct, e = '<'):
     with open(ib_filename, 'rb') as f:
@@ -212,16 +197,23 @@ def read_ib(ib_filename, fmt_struct, e = '<'):
 
 def write_ib_stream(ib_data, ib_stream, fmt_struct, e = '<'):
     # See above about cheating
-    ib_stride = int(int(re.findall("[0-9]+", fmt_struct["format"])[0])/8)
-    if len(ib_data) > 0:
+    ib_format = get_dxgi_format(fmt_struct["format"])
+    ib_stride = int(ib_format.bits/8)
+    if isinstance(ib_data, numpy.ndarray):
+        new_ib_data = ib_data.reshape(-1)
+    elif len(ib_data) > 0:
         if type(ib_data[0]) == list: # Flatten list for legacy code
             new_ib_data = [x for y in ib_data for x in y]
         else:
             new_ib_data = ib_data
     else:
         new_ib_data = ib_data
-    for i in range(len(new_ib_data)):
-        pack_dxgi_vector(ib_stream, [new_ib_data[i]], ib_stride, fmt_struct["format"], e)
+    if get_vector_format(ib_format, ib_stride) is not None and ib_format.numtype in ['UINT', 'SINT']:
+        ib_stream.write(convert_to_dxgi_array(numpy.asarray(new_ib_data, dtype = numpy.float64),
+            ib_format).astype(e + ib_format.numpy_code).tobytes())
+    else:
+        for i in range(len(new_ib_data)):
+            pack_dxgi_vector(ib_stream, [new_ib_data[i]], ib_stride, ib_format, e)
     return
 
 def write_ib(ib_data, ib_filename, fmt_struct, e = '<'):
@@ -229,62 +221,59 @@ def write_ib(ib_data, ib_filename, fmt_struct, e = '<'):
         write_ib_stream(ib_data, f, fmt_struct, e)
     return
 
-def read_vb_stream(vb_stream, fmt_struct, e = '<'):
+# Compiles fmt elements (all of them, or those of one input slot) into a numpy structured dtype with one field per
+# element, so that an entire vertex buffer can be decoded with a single frombuffer() call.
+def compile_vb_dtype(elements, stride, e = '<'):
+    names, formats, offsets, vector_formats = [], [], [], []
+    for i in range(len(elements)):
+        offset = int(elements[i]["AlignedByteOffset"])
+        if i == len(elements) - 1:
+            buffer_stride = stride - offset
+        else:
+            buffer_stride = int(elements[i+1]["AlignedByteOffset"]) - offset
+        vector_format = get_vector_format(elements[i]["Format"], buffer_stride)
+        names.append('element_{}'.format(i))
+        offsets.append(offset)
+        if vector_format is None:
+            formats.append('V{}'.format(buffer_stride))
+        else:
+            formats.append((e + vector_format.numpy_code, (vector_format.elements,)))
+        vector_formats.append(vector_format)
+    return(numpy.dtype({'names': names, 'formats': formats, 'offsets': offsets, 'itemsize': stride}), vector_formats)
+
+# Same values as unpack_dxgi_vector(), for a whole column of vectors
+def convert_dxgi_array(data, vector_format):
+    if vector_format.numtype == 'UNORM':
+        return(data.astype(numpy.float64) / ((2**vector_format.bits)-1))
+    elif vector_format.numtype == 'SNORM':
+        return(data.astype(numpy.float64) / ((2**(vector_format.bits-1))-1))
+    elif vector_format.numtype == 'FLOAT':
+        with numpy.errstate(invalid = 'ignore'): # NaNs are passed through, as struct does
+            return(data.astype(numpy.float64))
+    else:
+        return(data.astype(numpy.int64))
+
+def decode_vb_elements(vb_stream, elements, stride, element_keys, e = '<'):
+    vb_dtype, vector_formats = compile_vb_dtype(elements, stride, e)
+    vb_table = numpy.frombuffer(vb_stream, dtype = vb_dtype, count = len(vb_stream) // stride)
     vb_data = []
-    with io.BytesIO(vb_stream) as f:
-        length = f.seek(0,2)
-        f.seek(0)
-        num_vertex = int(length / int(fmt_struct["stride"]))
-        buffer_strides = []
-        # Calculate individual buffer strides
-        for i in range(len(fmt_struct["elements"])):
-            if i == len(fmt_struct["elements"]) - 1:
-                buffer_strides.append(int(fmt_struct["stride"]) - int(fmt_struct["elements"][i]["AlignedByteOffset"]))
-            else:
-                buffer_strides.append(int(fmt_struct["elements"][i+1]["AlignedByteOffset"]) \
-                    - int(fmt_struct["elements"][i]["AlignedByteOffset"]))
-        # Read in the buffers
-        for i in range(len(fmt_struct["elements"])):
-            element = {}
-            element["SemanticName"] = fmt_struct["elements"][i]["SemanticName"]
-            element["SemanticIndex"] = fmt_struct["elements"][i]["SemanticIndex"]
-            element_buffer = []
-            for j in range(num_vertex):
-                f.seek(j * int(fmt_struct["stride"]) + int(fmt_struct["elements"][i]["AlignedByteOffset"]),0)
-                element_buffer.append(unpack_dxgi_vector(f, buffer_strides[i], fmt_struct["elements"][i]["Format"], e))
-            element["Buffer"] = element_buffer
-            vb_data.append(element)
+    for i in range(len(elements)):
+        element = {key: elements[i][key] for key in element_keys}
+        if vector_formats[i] is None:
+            element["Buffer"] = [x.tobytes() for x in vb_table['element_{}'.format(i)]]
+        else:
+            element["Buffer"] = convert_dxgi_array(vb_table['element_{}'.format(i)], vector_formats[i])
+        vb_data.append(element)
     return(vb_data)
 
+def read_vb_stream(vb_stream, fmt_struct, e = '<'):
+    return(decode_vb_elements(vb_stream, fmt_struct["elements"], int(fmt_struct["stride"]),
+        ["SemanticName", "SemanticIndex"], e))
+
 def read_seg_vb_stream(vb_stream, fmt_struct, input_slot, e = '<'):
-    seg_stride = "vb{} stride".format(input_slot)
     seg_elements = [x for x in fmt_struct['elements'] if x['InputSlot'] == input_slot]
-    vb_data = []
-    with io.BytesIO(vb_stream) as f:
-        length = f.seek(0,2)
-        f.seek(0)
-        num_vertex = int(length / int(fmt_struct[seg_stride]))
-        buffer_strides = []
-        # Calculate individual buffer strides
-        for i in range(len(seg_elements)):
-            if i == len(seg_elements) - 1:
-                buffer_strides.append(int(fmt_struct[seg_stride]) - int(seg_elements[i]["AlignedByteOffset"]))
-            else:
-                buffer_strides.append(int(seg_elements[i+1]["AlignedByteOffset"]) \
-                    - int(seg_elements[i]["AlignedByteOffset"]))
-        # Read in the buffers
-        for i in range(len(seg_elements)):
-            element = {}
-            element["SemanticName"] = seg_elements[i]["SemanticName"]
-            element["SemanticIndex"] = seg_elements[i]["SemanticIndex"]
-            element["InputSlot"] = seg_elements[i]["InputSlot"]
-            element_buffer = []
-            for j in range(num_vertex):
-                f.seek(j * int(fmt_struct[seg_stride]) + int(seg_elements[i]["AlignedByteOffset"]),0)
-                element_buffer.append(unpack_dxgi_vector(f, buffer_strides[i], seg_elements[i]["Format"], e))
-            element["Buffer"] = element_buffer
-            vb_data.append(element)
-    return(vb_data)
+    return(decode_vb_elements(vb_stream, seg_elements, int(fmt_struct["vb{} stride".format(input_slot)]),
+        ["SemanticName", "SemanticIndex", "InputSlot"], e))
 
 def read_vb(vb_filename, fmt_struct, e = '<'):
     if 'stride' in fmt_struct:
@@ -300,52 +289,65 @@ def read_vb(vb_filename, fmt_struct, e = '<'):
         return(vb)
     else:
         print("Decoding error when trying to interpret fmt file for {0}!\r\n".format(vb_filename))
-        input("Press Enter to abort.")
+        if sys.stdin.isatty():
+            input("Press Enter to abort.")
         raise
 
-def write_vb_stream(vb_data, vb_stream, fmt_struct, e = '<', interleave = True):
-    buffer_strides = []
-    # Calculate individual buffer strides
-    for i in range(len(fmt_struct["elements"])):
-        if i == len(fmt_struct["elements"]) - 1:
-            buffer_strides.append(int(fmt_struct["stride"]) - int(fmt_struct["elements"][i]["AlignedByteOffset"]))
+# Inverse of convert_dxgi_array(), with the same clamping and rounding as pack_dxgi_vector()
+def convert_to_dxgi_array(data, vector_format):
+    if vector_format.numtype == 'UNORM':
+        return(numpy.rint(numpy.clip(data, 0, 1) * ((2**vector_format.bits)-1)))
+    elif vector_format.numtype == 'SNORM':
+        return(numpy.rint(numpy.clip(data, -1, 1) * ((2**(vector_format.bits-1))-1)))
+    elif vector_format.numtype in ['UINT', 'SINT']:
+        # Out of range values would silently wrap in numpy, so raise the same error that struct.pack() does
+        data = numpy.rint(data)
+        if vector_format.numtype == 'UINT':
+            int_min, int_max = 0, (2**vector_format.bits)-1
+        else:
+            int_min, int_max = -(2**(vector_format.bits-1)), (2**(vector_format.bits-1))-1
+        if not ((data >= int_min) & (data <= int_max)).all():
+            raise struct.error("{0} requires {1} <= number <= {2}".format(vector_format.format, int_min, int_max))
+        return(data)
+    else:
+        return(data)
+
+# Builds the whole vertex buffer as one structured array (interleaved) or one array per element (planar)
+def encode_vb_elements(vb_data, elements, stride, e = '<', interleave = True):
+    vb_dtype, vector_formats = compile_vb_dtype(elements, stride, e)
+    num_vertex = len(vb_data[0]["Buffer"])
+    columns = []
+    for i in range(len(elements)):
+        if vector_formats[i] is None: # Raw bytes
+            columns.append(numpy.frombuffer(b''.join(vb_data[i]["Buffer"][0:num_vertex]),
+                dtype = vb_dtype.fields['element_{}'.format(i)][0]))
         else:
-            buffer_strides.append(int(fmt_struct["elements"][i+1]["AlignedByteOffset"]) \
-                - int(fmt_struct["elements"][i]["AlignedByteOffset"]))
+            column = numpy.asarray(vb_data[i]["Buffer"])[0:num_vertex, 0:vector_formats[i].elements]
+            columns.append(convert_to_dxgi_array(column, vector_formats[i]))
     if interleave == True:
-        # Write out the buffers, vertex by vertex.
-        for j in range(len(vb_data[0]["Buffer"])):
-            for i in range(len(fmt_struct["elements"])):
-                pack_dxgi_vector(vb_stream, vb_data[i]["Buffer"][j], buffer_strides[i], fmt_struct["elements"][i]["Format"], e)
+        vb_table = numpy.zeros(num_vertex, dtype = vb_dtype)
+        for i in range(len(elements)):
+            vb_table['element_{}'.format(i)] = columns[i]
+        return(vb_table.tobytes())
     else:
-        # Write out the buffers, element by element.
-        for i in range(len(fmt_struct["elements"])):
-            for j in range(len(vb_data[0]["Buffer"])):
-                pack_dxgi_vector(vb_stream, vb_data[i]["Buffer"][j], buffer_strides[i], fmt_struct["elements"][i]["Format"], e)
+        planar_buffers = []
+        for i in range(len(elements)):
+            element_buffer = numpy.zeros(num_vertex, dtype = vb_dtype.fields['element_{}'.format(i)][0])
+            element_buffer[...] = columns[i]
+            planar_buffers.append(element_buffer.tobytes())
+        return(b''.join(planar_buffers))
+
+def write_vb_stream(vb_data, vb_stream, fmt_struct, e = '<', interleave = True):
+    if len(vb_data) > 0 and len(vb_data[0]["Buffer"]) > 0:
+        vb_stream.write(encode_vb_elements(vb_data, fmt_struct["elements"], int(fmt_struct["stride"]), e, interleave))
     return
 
 def write_seg_vb_stream(vb_data, vb_stream, fmt_struct, input_slot, e = '<', interleave = True):
-    buffer_strides = []
     seg_stride = fmt_struct["vb{} stride".format(input_slot)]
     seg_vb_data = [x for x in vb_data if x['InputSlot'] == input_slot]
     seg_elements = [x for x in fmt_struct['elements'] if x['InputSlot'] == input_slot]
-    # Calculate individual buffer strides
-    for i in range(len(seg_elements)):
-        if i == len(seg_elements) - 1:
-            buffer_strides.append(int(seg_stride) - int(seg_elements[i]["AlignedByteOffset"]))
-        else:
-            buffer_strides.append(int(seg_elements[i+1]["AlignedByteOffset"]) \
-                - int(seg_elements[i]["AlignedByteOffset"]))
-    if interleave == True:
-        # Write out the buffers, vertex by vertex.
-        for j in range(len(seg_vb_data[0]["Buffer"])):
-            for i in range(len(seg_elements)):
-                pack_dxgi_vector(vb_stream, seg_vb_data[i]["Buffer"][j], buffer_strides[i], seg_elements[i]["Format"], e)
-    else:
-        # Write out the buffers, element by element.
-        for i in range(len(seg_elements)):
-            for j in range(len(seg_vb_data[0]["Buffer"])):
-                pack_dxgi_vector(vb_stream, seg_vb_data[i]["Buffer"][j], buffer_strides[i], seg_elements[i]["Format"], e)
+    if len(seg_vb_data) > 0 and len(seg_vb_data[0]["Buffer"]) > 0:
+        vb_stream.write(encode_vb_elements(seg_vb_data, seg_elements, int(seg_stride), e, interleave))
     return
 
 def write_vb(vb_data, vb_filename, fmt_struct, e = '<', interleave = True):
@@ -358,7 +360,8 @@ def write_vb(vb_data, vb_filename, fmt_struct, e = '<', interleave = True):
                 write_seg_vb_stream(vb_data, f, fmt_struct, input_slot, e=e, interleave=interleave)
     else:
         print("Decoding error when trying to interpret fmt file for {0}!\r\n".format(vb_filename))
-        input("Press Enter to abort.")
+        if sys.stdin.isatty():
+            input("Press Enter to abort.")
         raise
     return
 
@@ -371,7 +374,8 @@ def read_struct_from_json(filename, raise_on_fail = True):
             print("Decoding error when trying to read JSON file {0}!\r\n".format(filename))
             print("{0} at line {1} column {2} (character {3})\r\n".format(e.msg, e.lineno, e.colno, e.pos))
             if raise_on_fail == True:
-                input("Press Enter to abort.")
+                if sys.stdin.isatty():
+                    input("Press Enter to abort.")
                 raise
             else:
                 return(False)
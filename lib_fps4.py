@@ -0,0 +1,174 @@
+# A small library for reading FPS4 archives (and the TLZC-decompressed data inside them)
+# without copying the archive contents.
+#
+# GitHub eArmada8/vesperia_model_tool
+
+import struct, mmap, functools, os
+
+# File-like cursor over a bytes-like object (bytes, bytearray or mmap).  The data is never copied as a whole;
+# read() copies only the requested bytes, and unpack() / unpack_from() decode in place with struct.unpack_from.
+# offset and size restrict the reader to a window of the data, e.g. a single file inside a mapped archive.
+class BinaryReader:
+    def __init__ (self, data, mmap_file = None, offset = 0, size = None):
+        self.data = data
+        self.data_offset = offset
+        self.view = memoryview(data)[offset:None if size is None else offset + size]
+        self.pos = 0
+        self.mmap_file = mmap_file
+        self.strings = {} # Names are shared within sections, so decoded strings are kept by offset
+
+    def __enter__ (self):
+        return(self)
+
+    # Arrays made with numpy.frombuffer(reader.view) can still be alive while an exception is being raised out
+    # of the with block, in which case the view and mapping cannot be closed yet.  That BufferError would replace
+    # the original exception, so it is only raised when leaving the block normally.
+    def __exit__ (self, exc_type, exc_value, traceback):
+        try:
+            self.close()
+        except BufferError:
+            if exc_type is None:
+                raise
+
+    def __len__ (self):
+        return(len(self.view))
+
+    # The references are dropped before anything is closed, so if a view is still in use the mapping is freed
+    # along with the last array pointing into it.
+    def close (self):
+        mmap_file = self.mmap_file
+        self.data, self.mmap_file = None, None
+        self.view.release()
+        if mmap_file is not None:
+            mmap_file.close()
+
+    def seek (self, offset, whence = 0):
+        if whence == 0:
+            self.pos = offset
+        elif whence == 1:
+            self.pos += offset
+        elif whence == 2:
+            self.pos = len(self.view) + offset
+        return(self.pos)
+
+    def tell (self):
+        return(self.pos)
+
+    def read (self, size = -1):
+        end = len(self.view) if size < 0 else min(self.pos + size, len(self.view))
+        data = bytes(self.view[self.pos:end])
+        self.pos = max(self.pos, end)
+        return(data)
+
+    # fmt is either a format string or a precompiled struct.Struct
+    def unpack (self, fmt):
+        if isinstance(fmt, struct.Struct):
+            values = fmt.unpack_from(self.view, self.pos)
+            self.pos += fmt.size
+        else:
+            values = struct.unpack_from(fmt, self.view, self.pos)
+            self.pos += struct.calcsize(fmt)
+        return(values)
+
+    def unpack_from (self, fmt, offset):
+        if isinstance(fmt, struct.Struct):
+            return(fmt.unpack_from(self.view, offset))
+        else:
+            return(struct.unpack_from(fmt, self.view, offset))
+
+    # Null-terminated string at offset, does not move the cursor
+    def read_string (self, offset):
+        if offset not in self.strings:
+            end = self.data.find(b'\x00', self.data_offset + offset, self.data_offset + len(self.view))
+            self.strings[offset] = bytes(self.view[offset:end - self.data_offset if end > -1 else len(self.view)]).decode()
+        return(self.strings[offset])
+
+# Table of contents of an FPS4 archive, parsed once.  Entries can be looked up by index (entries) or by
+# name (by_name, names can repeat so each name maps to a list of indices).  Entry data is only touched
+# when asked for, either as a memoryview into the reader (view) or as a copy (read).  Nested archives
+# are opened on the same reader (open), so nothing is copied there either.
+class FPS4Archive:
+    def __init__ (self, reader, base_offset = 0, offset_multiplier = 1):
+        self.reader = reader
+        self.base_offset = base_offset
+        self.header = reader.unpack_from(">3I2H2I", base_offset + 4) # num_entries, unk, len_header, entry_stride, unk * 3
+        self.num_entries = self.header[0]
+        self.entry_stride = self.header[3]
+        self.entries = []
+        self.by_name = {}
+        toc_offset = base_offset + 0x1C
+        for i in range(self.num_entries - 1): # The final entry is padding
+            entry_offset = toc_offset + (i * self.entry_stride)
+            toc_entry = reader.unpack_from(">3I", entry_offset) # offset, padded length, true length
+            if self.entry_stride >= 0x2C: # Name is stored in the entry, e.g. .svo files
+                name = reader.unpack_from("32s", entry_offset + 12)[0].rstrip(b'\x00').decode('utf-8')
+            elif self.entry_stride >= 0x10: # Entry has an offset to the name
+                name = reader.read_string(base_offset + reader.unpack_from(">I", entry_offset + 12)[0])
+            else:
+                name = ''
+            self.entries.append({'name': name, 'offset': base_offset + (toc_entry[0] * offset_multiplier),
+                'padded_size': toc_entry[1], 'true_size': toc_entry[2]})
+            if name in self.by_name:
+                self.by_name[name].append(i)
+            else:
+                self.by_name[name] = [i]
+        # Entries without names (shell type) are followed by the name of the archive itself
+        if self.entry_stride < 0x10:
+            self.name = reader.read_string(toc_offset + (self.num_entries * self.entry_stride))
+        else:
+            self.name = ''
+
+    def __len__ (self):
+        return(len(self.entries))
+
+    def view (self, index, padded = False):
+        entry = self.entries[index]
+        return(self.reader.view[entry['offset']:entry['offset'] + entry['padded_size' if padded else 'true_size']])
+
+    def read (self, index, padded = False):
+        return(bytes(self.view(index, padded = padded)))
+
+    def open (self, index):
+        entry = self.entries[index]
+        if entry['true_size'] >= 0x1C and self.reader.unpack_from("4s", entry['offset'])[0] == b'FPS4':
+            return(FPS4Archive(self.reader, entry['offset']))
+        else:
+            return(None)
+
+@functools.lru_cache(maxsize = 16)
+def read_svo_toc_cached (svo_file, mtime, size):
+    # Only the pages holding the table of contents are actually read from the mapped file
+    with open(svo_file, 'rb') as f:
+        svo_data = mmap.mmap(f.fileno(), 0, access = mmap.ACCESS_READ)
+    with BinaryReader(svo_data, mmap_file = svo_data) as svo:
+        magic = svo.read(4)
+        if magic == b'FPS4':
+            return(FPS4Archive(svo, offset_multiplier = 0x80).entries)
+        else:
+            return([])
+
+def read_svo_toc (svo_file):
+    svo_stat = os.stat(svo_file)
+    return([dict(x) for x in read_svo_toc_cached(os.path.abspath(svo_file), svo_stat.st_mtime_ns, svo_stat.st_size)])
+
+# Files inside .svo archives can be addressed as "archive.svo:FILE_NAME", for example "chara.svo:EST_C000.DAT"
+def split_svo_path (filename):
+    svo_file, separator, entry_name = filename.rpartition(':')
+    if separator == ':' and svo_file[-4:].lower() == '.svo':
+        return(svo_file, entry_name)
+    else:
+        return(filename, '')
+
+def find_svo_entry (svo_file, entry_name):
+    if os.path.isfile(svo_file):
+        for entry in read_svo_toc(svo_file):
+            if entry['name'] == entry_name:
+                return(entry)
+    return(None)
+
+def svo_path_exists (filename):
+    svo_file, entry_name = split_svo_path(filename)
+    if entry_name == '':
+        return(os.path.exists(filename))
+    else:
+        return(find_svo_entry(svo_file, entry_name) is not None)
@@ -0,0 +1,87 @@
+# A small library for converting triangle lists into a single triangle strip, as an alternative to the (much
+# slower) pure-python NvTriStrip port in pyffi_tstrip.  Strips follow the DirectX winding convention used by
+# trianglestrip_to_list() (every odd triangle of a strip is read as (0, 2, 1)), and separate strips are
+# stitched together with degenerate triangles, so the result never needs a primitive restart.
+#
+# GitHub eArmada8/vesperia_model_tool
+
+import numpy
+
+# Neighbour of every triangle across each of its edges (v0->v1, v1->v2, v2->v0) as an (N,3) table, -1 for open
+# edges.  A neighbour has the same winding, so it holds the shared edge in the opposite direction.  Where more
+# than two triangles share an edge, the first one is used.
+def build_adjacency (triangles):
+    if len(triangles) == 0:
+        return(numpy.zeros((0, 3), dtype = numpy.int64))
+    num_vertices = int(triangles.max()) + 1
+    edges_from = triangles.reshape(-1)
+    edges_to = triangles[:,[1,2,0]].reshape(-1)
+    edge_order = numpy.argsort(edges_from * num_vertices + edges_to, kind = 'stable')
+    sorted_keys = (edges_from * num_vertices + edges_to)[edge_order]
+    reverse_keys = edges_to * num_vertices + edges_from
+    position = numpy.minimum(numpy.searchsorted(sorted_keys, reverse_keys), len(sorted_keys) - 1)
+    adjacency = numpy.where(sorted_keys[position] == reverse_keys, edge_order[position] // 3, -1)
+    return(adjacency.reshape(-1, 3))
+
+# Walks from triangle start (first vertex at rotation) to unused neighbours for as long as the strip continues.
+# Returns the strip and the triangles in it, without marking them as used.
+def grow_strip (triangles, adjacency, used, start, rotation):
+    tri = triangles[start]
+    strip = [tri[rotation], tri[(rotation + 1) % 3], tri[(rotation + 2) % 3]]
+    strip_triangles = [start]
+    in_strip = set(strip_triangles)
+    current = start
+    while True:
+        # Edge shared with the next triangle, in the winding of the current triangle
+        if len(strip) % 2 == 1:
+            a, b = strip[-2], strip[-1]
+        else:
+            a, b = strip[-1], strip[-2]
+        tri = triangles[current]
+        j = 0 if (tri[0] == a and tri[1] == b) else 1 if (tri[1] == a and tri[2] == b) else 2
+        neighbour = adjacency[current][j]
+        if neighbour < 0 or used[neighbour] or neighbour in in_strip:
+            break
+        tri = triangles[neighbour]
+        k = 0 if (tri[0] == b and tri[1] == a) else 1 if (tri[1] == b and tri[2] == a) else 2
+        strip.append(tri[(k + 2) % 3])
+        strip_triangles.append(neighbour)
+        in_strip.add(neighbour)
+        current = neighbour
+    return(strip, strip_triangles)
+
+# Joins strips with degenerate triangles.  An extra vertex is added where needed so that every strip starts on
+# an even triangle and keeps its winding.
+def stitch_strips (strips):
+    stitched = []
+    for strip in strips:
+        if len(stitched) > 0:
+            stitched.extend([stitched[-1]] * (2 if len(stitched) % 2 == 1 else 1) + [strip[0]])
+        stitched.extend(strip)
+    return(stitched)
+
+# Greedy stripifier:  strips are started from the triangles with the fewest neighbours first, and each start is
+# tried in all three rotations, keeping the longest strip.  Degenerate triangles are dropped.  Returns the
+# stitched strip as an int64 array.
+def stripify_greedy (triangles):
+    triangles = numpy.asarray(triangles, dtype = numpy.int64).reshape(-1)
+    triangles = triangles[0:(len(triangles) // 3) * 3].reshape(-1, 3)
+    triangles = triangles[(triangles[:,0] != triangles[:,1]) & (triangles[:,1] != triangles[:,2])
+        & (triangles[:,0] != triangles[:,2])]
+    adjacency = build_adjacency(triangles)
+    start_order = numpy.argsort((adjacency >= 0).sum(axis = 1), kind = 'stable').tolist()
+    triangles, adjacency = triangles.tolist(), adjacency.tolist()
+    used = [False] * len(triangles)
+    strips = []
+    for start in start_order:
+        if used[start]:
+            continue
+        best_strip, best_triangles = grow_strip(triangles, adjacency, used, start, 0)
+        for rotation in [1, 2]:
+            strip, strip_triangles = grow_strip(triangles, adjacency, used, start, rotation)
+            if len(strip_triangles) > len(best_triangles):
+                best_strip, best_triangles = strip, strip_triangles
+        for i in best_triangles:
+            used[i] = True
+        strips.append(best_strip)
+    return(numpy.array(stitch_strips(strips), dtype = numpy.int64))
@@ -0,0 +1,125 @@
+# Benchmarks for the slower steps of the Tales of Vesperia DE (PC/Steam) model toolset.
+#
+# Usage:  Run by itself without commandline arguments and it will search for model .DAT files
+# and compare TLZC compression (zlib mode 2 vs. chunked LZMA mode 4) and the triangle stripifiers
+# used on import (greedy vs. pyffi) on each.
+#
+# For command line options, run:
+# /path/to/python3 vesperia_benchmark.py --help
+#
+# Requires vesperia_import_model.py and its dependencies, put in the same directory
+#
+# GitHub eArmada8/vesperia_model_tool
+
+try:
+    import time, glob, os, sys
+    from vesperia_import_model import *
+except ModuleNotFoundError as e:
+    print("Python module missing! {}".format(e.msg))
+    if sys.stdin.isatty():
+        input("Press Enter to abort.")
+    raise
+
+def read_unc_data (mdl_file):
+    with open(mdl_file, 'rb') as f:
+        magic = f.read(4)
+        if magic == b'TLZC':
+            unc_data = decompress_tlzc(f)
+        elif magic == b'FPS4':
+            f.seek(0)
+            unc_data = f.read()
+        else:
+            unc_data = b''
+    return(unc_data)
+
+# Triangle lists of every submesh of every model inside a model .DAT
+def read_model_triangles (mdl_file):
+    triangles = []
+    with open_mdl_data(mdl_file) as f:
+        codec = byte_order_codecs['<']
+        magic = f.read(4)
+        if magic == b'FPS4':
+            model_archive = FPS4Archive(f).open(0)
+            if model_archive is not None:
+                toc_1 = model_archive.entries
+                for model in model_archive.by_name:
+                    meshes_i, bone_palette_ids_i, mesh_blocks_info_i = read_mesh_section (f,
+                        toc_1[model_archive.by_name[model][6]]['offset'],
+                        toc_1[model_archive.by_name[model][7]]['offset'], codec)
+                    triangles.extend([x['ib'] for x in meshes_i])
+    return(triangles)
+
+# Triangles as a sorted list with each triangle rotated to start at its lowest index (keeping the winding),
+# so that the output of a stripifier can be checked against its input
+def canonical_triangles (triangles):
+    triangles = numpy.asarray(triangles, dtype = numpy.int64).reshape(-1, 3)
+    triangles = triangles[(triangles[:,0] != triangles[:,1]) & (triangles[:,1] != triangles[:,2])
+        & (triangles[:,0] != triangles[:,2])]
+    rotation = numpy.argmin(triangles, axis = 1)
+    triangles = numpy.take_along_axis(triangles, (rotation[:,None] + numpy.arange(3)) % 3, axis = 1)
+    return(sorted([tuple(x) for x in triangles.tolist()]))
+
+def benchmark_stripify (mdl_file, engines = ['greedy', 'pyffi']):
+    triangles = read_model_triangles(mdl_file)
+    if len(triangles) == 0:
+        print("{} has no meshes, skipping...".format(mdl_file))
+        return
+    print("{0} ({1} submeshes, {2} triangles):".format(mdl_file, len(triangles), sum([len(x) for x in triangles])))
+    print("  {0:<16}{1:>12}{2:>12}".format('Stripifier', 'Indices', 'Time'))
+    for engine in engines:
+        start_time = time.perf_counter()
+        strips = [stripifiers[engine](x) for x in triangles]
+        strip_time = time.perf_counter() - start_time
+        round_trip = all([canonical_triangles(trianglestrip_to_list(strips[i])) == canonical_triangles(triangles[i])
+            for i in range(len(triangles))])
+        print("  {0:<16}{1:>12}{2:>11.3f}s{3}".format(engine, sum([len(x) for x in strips]), strip_time,
+            '' if round_trip else '  ROUND TRIP FAILED!'))
+    return
+
+def benchmark_tlzc (mdl_file, lzma_presets = [0, 6, 9]):
+    unc_data = read_unc_data(mdl_file)
+    if len(unc_data) == 0:
+        print("{} is not a TLZC or FPS4 file, skipping...".format(mdl_file))
+        return
+    print("{0} ({1} bytes uncompressed):".format(mdl_file, len(unc_data)))
+    print("  {0:<16}{1:>12}{2:>9}{3:>12}{4:>12}".format('Method', 'Size', 'Ratio', 'Compress', 'Decompress'))
+    for mode, preset in [(2, 6)] + [(4, x) for x in lzma_presets]:
+        start_time = time.perf_counter()
+        cmp_data = compress_tlzc(unc_data, mode = mode, preset = preset)
+        cmp_time = time.perf_counter() - start_time
+        start_time = time.perf_counter()
+        with io.BytesIO(cmp_data) as f:
+            f.seek(4)
+            dec_data = decompress_tlzc(f)
+        dec_time = time.perf_counter() - start_time
+        method = 'zlib (mode 2)' if mode == 2 else 'lzma -{} (mode 4)'.format(preset)
+        print("  {0:<16}{1:>12}{2:>9.3f}{3:>11.3f}s{4:>11.3f}s{5}".format(method, len(cmp_data),
+            len(cmp_data) / len(unc_data), cmp_time, dec_time, '' if dec_data == unc_data else '  ROUND TRIP FAILED!'))
+    return
+
+if __name__ == "__main__":
+    # Set current directory
+    if getattr(sys, 'frozen', False):
+        os.chdir(os.path.dirname(sys.executable))
+    else:
+        os.chdir(os.path.abspath(os.path.dirname(__file__)))
+
+    if len(sys.argv) > 1:
+        import argparse
+        parser = argparse.ArgumentParser()
+        parser.add_argument('-p', '--presets', help="Comma-separated LZMA presets to test, default 0,6,9", default='0,6,9')
+        parser.add_argument('-m', '--mode', help="Benchmark to run, tlzc, stripify or all (default)",
+            choices=['tlzc', 'stripify', 'all'], default='all')
+        parser.add_argument('mdl_file', help="Name of model .DAT file to benchmark.")
+        args = parser.parse_args()
+        if os.path.exists(args.mdl_file):
+            if args.mode in ['tlzc', 'all']:
+                benchmark_tlzc(args.mdl_file, lzma_presets = [int(x) for x in args.presets.split(',')])
+            if args.mode in ['stripify', 'all']:
+                benchmark_stripify(args.mdl_file)
+    else:
+        mdl_files = glob.glob('*.DAT')
+        for mdl_file in mdl_files:
+            benchmark_tlzc(mdl_file)
+            if not mdl_file == 'BASEBONES.DAT':
+                benchmark_stripify(mdl_file)
@@ -6,44 +6,116 @@
 # For command line options, run:
 # /path/to/python3 vesperia_export_model.py --help
 #
-# Requires lib_fmtibvb.py, put in the same directory
+# Requires lib_fmtibvb.py and lib_fps4.py, put in the same directory
 #
 # GitHub eArmada8/vesperia_model_tool
 
 try:
-    import struct, json, numpy, copy, zlib, lzma, io, glob, os, sys
+    import sys, struct, json, numpy, copy, zlib, lzma, mmap, io, functools, glob, fnmatch, os, concurrent.futures
     from lib_fmtibvb import *
+    from lib_fps4 import *
 except ModuleNotFoundError as e:
     print("Python module missing! {}".format(e.msg))
-    input("Press Enter to abort.")
+    if sys.stdin.isatty():
+        input("Press Enter to abort.")
     raise
 
-# Global variable, do not edit
-e = '<'
+# Byte order of the data being read or written, with its struct formats compiled once on first use.  The codec is
+# passed to every function that needs it instead of being a global, so models can be processed concurrently.
+class Codec:
+    def __init__ (self, endianness = '<'):
+        self.e = endianness
+        self.structs = {}
 
-def set_endianness (endianness):
-    global e
-    if endianness in ['<', '>']:
-        e = endianness
-    return
+    # codec['4I'] is a struct.Struct for "<4I" or ">4I"
+    def __getitem__ (self, fmt):
+        compiled = self.structs.get(fmt)
+        if compiled is None:
+            compiled = self.structs.setdefault(fmt, struct.Struct(self.e + fmt))
+        return(compiled)
+
+byte_order_codecs = {'<': Codec('<'), '>': Codec('>')}
 
-def read_offset (f):
+def read_offset (f, codec = byte_order_codecs['<']):
     start_offset = f.tell()
-    diff_offset, = struct.unpack("{}I".format(e), f.read(4))
+    diff_offset, = f.unpack(codec['I'])
     return(start_offset + diff_offset)
 
+# Arrays whose length is only known from the data, e.g. read_array(f, 'u4', num_bones) for num_bones uint32s.
+# These are read with numpy instead of the codec, so that the codec only caches fixed formats.
+def read_array (f, numpy_code, count, codec = byte_order_codecs['<']):
+    values = numpy.frombuffer(f.view, dtype = codec.e + numpy_code, count = count, offset = f.tell()).tolist()
+    f.seek(count * numpy.dtype(numpy_code).itemsize, 1)
+    return(values)
+
 def read_string (f, start_offset):
-    current_loc = f.tell()
-    f.seek(start_offset)
-    null_term_string = f.read(1)
-    while null_term_string[-1] != 0:
-        null_term_string += f.read(1)
-    f.seek(current_loc)
-    return(null_term_string[:-1].decode())
+    return(f.read_string(start_offset))
 
 def round_up_align (val, align = 16):
     return ((val // align) * align + align if val % align > 0 else val)
 
+# Fixed-size records, each table is decoded at once by read_table().  Formats are NumPy type codes without
+# byte order, which is added by get_table_dtype().  'offset' fields are stored relative to their own
+# position (see read_offset()) and read_table() returns them as absolute offsets.
+table_schemas = {
+    'bone': [('unk0', 'i4'), ('parent', 'i4'), ('unk1', ('i4', 4)), ('name_offset', 'offset'), ('name_end_offset', 'offset')],
+    'matrix': [('matrix', ('f4', 16))],
+    'bounding_sphere': [('center', ('f4', 3)), ('radius', 'f4'), ('num_verts', ('u4', 4))],
+    'mesh_unk': [('unk_fltarr', ('f4', 4))],
+    'mesh_header': [('flags', 'u4'), ('mesh', 'u4'), ('submesh', 'u4'), ('node', 'u4'), ('material_id', 'u4'),
+        ('uv_offset', 'u4'), ('idx_offset', 'offset'), ('vert_offset', 'offset'), ('uv_stride', 'u4'),
+        ('flags2', 'u4'), ('total_verts', 'u4'), ('total_idx', 'u4'), ('unk', 'u4'),
+        ('name_offset', 'offset'), ('name_end_offset', 'offset')],
+    'material': [('num_tex', 'i4'), ('internal_id', 'i4'), ('base_0', 'i4'), ('base_1', 'f4'), ('base_2', ('i4', 4))],
+    'material_tex': [('tex', ('i4', 2))],
+    'material_name': [('unk1', 'u4'), ('name_offset', 'offset'), ('name_end_offset', 'offset'), ('unk2', 'u4')],
+    'material_tex_name': [('name_offset', 'offset'), ('tex_val', 'u4')],
+    'material_floats': [('base_floats', ('f4', 4))],
+    'material_tex_floats': [('tex_floats', ('f4', 6))],
+    'texture': [('dwWidth', 'i4'), ('dwHeight', 'i4'), ('dwMipMapCount', 'i4'), ('type', 'i4'),
+        ('name_offset', 'offset'), ('offset', 'u4'), ('unk', 'u4')],
+}
+
+@functools.lru_cache(maxsize = None)
+def get_table_dtype (schema, endianness):
+    fields = []
+    for name, fmt in table_schemas[schema]:
+        if fmt == 'offset':
+            fields.append((name, endianness + 'u4'))
+        elif isinstance(fmt, tuple):
+            fields.append((name, endianness + fmt[0], fmt[1:]))
+        else:
+            fields.append((name, endianness + fmt))
+    return(numpy.dtype(fields))
+
+# Offsets of variable length tables, e.g. counts[i] records of size stride starting at starts[i]
+def ragged_offsets (starts, counts, stride):
+    counts = numpy.asarray(counts, dtype = numpy.int64)
+    first = numpy.cumsum(counts) - counts
+    return(numpy.repeat(numpy.asarray(starts, dtype = numpy.int64) - (first * stride), counts)
+        + numpy.arange(counts.sum()) * stride)
+
+# Decodes count records from the current position, or one record from each of offsets, and returns a dict of
+# columns (as lists).
+def read_table (f, schema, count = 0, offsets = None, codec = byte_order_codecs['<']):
+    dtype = get_table_dtype(schema, codec.e)
+    if offsets is None:
+        start_offset = f.tell()
+        table = numpy.frombuffer(f.view, dtype = dtype, count = count, offset = start_offset)
+        offsets = start_offset + numpy.arange(count, dtype = numpy.int64) * dtype.itemsize
+        f.seek(start_offset + (count * dtype.itemsize))
+    else:
+        offsets = numpy.asarray(offsets, dtype = numpy.int64).reshape(-1)
+        raw_data = numpy.frombuffer(f.view, dtype = numpy.uint8)
+        table = raw_data[offsets[:,None] + numpy.arange(dtype.itemsize)].view(dtype).reshape(-1)
+    columns = {}
+    for name, fmt in table_schemas[schema]:
+        if fmt == 'offset':
+            columns[name] = (offsets + dtype.fields[name][1] + table[name]).tolist()
+        else:
+            columns[name] = table[name].tolist()
+    return(columns)
+
 def decompress_tlzc (f): # Mode 2 and 4 only currently, credit and thank you to github.com/AdmiralCurtiss/HyoutaTools
     header = struct.unpack("<5I", f.read(20))
     if header[0] >> 8 & 0xFF == 2:
@@ -55,136 +127,261 @@ def decompress_tlzc (f): # Mode 2 and 4 only currently, credit and thank you to
             "lp": (lzma_header[0] // 9) % 5, "pb": (lzma_header[0] // 9) // 5, "mode": lzma.MODE_NORMAL}]
         num_streams = (header[2] + 0xFFFF) >> 16
         streams = list(struct.unpack("<{}H".format(num_streams), f.read(2 * num_streams)))
-        unc_data = bytearray()
+        cmp_data = memoryview(f.read())
+        # Every stream decodes into its own 64 KiB slot, so the streams can be decoded in any order
+        unc_data = bytearray(header[2])
+        unc_view = memoryview(unc_data)
+        lzma_streams = [] # cmp_offset, cmp_length, unc_offset, unc_length
+        cmp_offset = 0
         for i in range(len(streams)):
+            unc_offset = i * 0x10000
+            unc_length = min(header[2] - unc_offset, 0x10000)
             if not streams[i] == 0:
-                lzma_dec = lzma.LZMADecompressor(format = lzma.FORMAT_RAW, filters=filters)
-                unc_data.extend(lzma_dec.decompress(f.read(streams[i]), max_length = min(header[2] - len(unc_data), 0x10000)))
-            else:
-                unc_data.extend(f.read(min(header[2] - len(unc_data), 0x10000)))
+                lzma_streams.append((cmp_offset, streams[i], unc_offset, unc_length))
+                cmp_offset += streams[i]
+            else: # Stored without compression
+                unc_view[unc_offset:unc_offset + unc_length] = cmp_data[cmp_offset:cmp_offset + unc_length]
+                cmp_offset += unc_length
+        def decompress_lzma_stream (lzma_stream):
+            cmp_offset, cmp_length, unc_offset, unc_length = lzma_stream
+            lzma_dec = lzma.LZMADecompressor(format = lzma.FORMAT_RAW, filters=filters)
+            dec_data = lzma_dec.decompress(cmp_data[cmp_offset:cmp_offset + cmp_length], max_length = unc_length)
+            unc_view[unc_offset:unc_offset + len(dec_data)] = dec_data
+            return
+        # lzma releases the GIL while decoding, so threads are enough to use all cores
+        with concurrent.futures.ThreadPoolExecutor() as executor:
+            list(executor.map(decompress_lzma_stream, lzma_streams))
+        unc_view.release()
         return(unc_data)
     else:
         return(b'')
 
+def open_mdl_data (mdl_file):
+    # Compressed files are decompressed into memory; anything else is mapped instead of read.  Files inside
+    # an .svo archive ("chara.svo:EST_C000.DAT") are read from their window of the mapped archive.
+    mdl_file, entry_name = split_svo_path(mdl_file)
+    if entry_name == '':
+        offset, size = 0, os.path.getsize(mdl_file)
+    else:
+        entry = find_svo_entry(mdl_file, entry_name)
+        if entry is None:
+            raise FileNotFoundError("{0} not found in {1}!".format(entry_name, mdl_file))
+        offset, size = entry['offset'], entry['true_size']
+    if size == 0:
+        return(BinaryReader(b''))
+    with open(mdl_file, 'rb') as f:
+        mmap_file = mmap.mmap(f.fileno(), 0, access = mmap.ACCESS_READ)
+    mdl_data = BinaryReader(mmap_file, mmap_file = mmap_file, offset = offset, size = size)
+    magic = mdl_data.read(4)
+    if magic == b'TLZC':
+        with mdl_data:
+            return(BinaryReader(decompress_tlzc(mdl_data)))
+    else:
+        mdl_data.seek(0)
+        return(mdl_data)
+
 def trianglestrip_to_list(ib_list):
-    triangles = []
-    split_lists = [[]]
-    # Split ib_list by primitive restart command, some models have this
-    for i in range(len(ib_list)):
-        if not ib_list[i] == -1:
-            split_lists[-1].append(ib_list[i])
-        else:
-            split_lists.append([])
-    for i in range(len(split_lists)):
-        for j in range(len(split_lists[i])-2):
-            if j % 2 == 0:
-                triangles.append([split_lists[i][j], split_lists[i][j+1], split_lists[i][j+2]])
-            else:
-                triangles.append([split_lists[i][j], split_lists[i][j+2], split_lists[i][j+1]]) #DirectX implementation
-                #triangles.append([split_lists[i][j+1], split_lists[i][j], split_lists[i][j+2]]) #OpenGL implementation
+    ib = numpy.asarray(ib_list, dtype = numpy.int64).reshape(-1)
+    if len(ib) < 3:
+        return(numpy.zeros((0, 3), dtype = numpy.int64))
+    # Every run of 3 indices is a triangle, unless it crosses a primitive restart (-1), some models have this
+    triangles = numpy.stack([ib[:-2], ib[1:-1], ib[2:]], axis = 1)
+    valid = (triangles != -1).all(axis = 1)
+    # Winding alternates within each strip, counting from the start of the strip
+    strip_starts = numpy.flatnonzero(ib[:-1] == -1) + 1
+    strip_start = numpy.zeros(len(ib), dtype = numpy.int64)
+    strip_start[strip_starts] = strip_starts
+    strip_pos = numpy.arange(len(ib)) - numpy.maximum.accumulate(strip_start)
+    odd = (strip_pos[:-2] % 2 == 1)
+    triangles[odd] = triangles[odd][:,[0,2,1]] #DirectX implementation
+    #triangles[odd] = triangles[odd][:,[1,0,2]] #OpenGL implementation
     # Remove degenerate triangles
-    triangles = [x for x in triangles if len(set(x)) == 3]
-    return(triangles)
+    valid &= (triangles[:,0] != triangles[:,1]) & (triangles[:,1] != triangles[:,2]) & (triangles[:,0] != triangles[:,2])
+    return(triangles[valid])
+
+# Local (parent-relative) matrices of a skeleton, from the absolute and inverse bind matrices as (N,4,4) arrays,
+# both row major.  Bones whose parent is not in the skeleton keep their absolute matrix.
+def compute_local_matrices (abs_mtx, inv_mtx, parents):
+    has_parent = (parents >= 0) & (parents < len(parents))
+    local_mtx = abs_mtx.copy()
+    local_mtx[has_parent] = numpy.matmul(abs_mtx[has_parent], inv_mtx[parents[has_parent]])
+    return(local_mtx)
+
+# Children lists of every bone (in index order) from the parent indices
+def compute_children (parents):
+    if len(parents) == 0:
+        return([])
+    child_bones = numpy.flatnonzero((parents >= 0) & (parents < len(parents)))
+    child_bones = child_bones[numpy.argsort(parents[child_bones], kind = 'stable')]
+    num_children = numpy.bincount(parents[child_bones], minlength = len(parents))
+    return([x.tolist() for x in numpy.split(child_bones, numpy.cumsum(num_children)[:-1])])
 
-def read_skel_section (f, start_offset):
+# ids_only = True stops after the list of bone ids, which is all that matching bone palettes needs
+def read_skel_section (f, start_offset, codec = byte_order_codecs['<'], ids_only = False):
     f.seek(start_offset)
-    header = struct.unpack("{}6I".format(e), f.read(24)) #unk0, size, unk1, num_bones, unk2, unk3, unk4
-    mtx_offset = read_offset(f)
+    header = f.unpack(codec['6I']) #unk0, size, unk1, num_bones, unk2, unk3, unk4
+    mtx_offset = read_offset(f, codec)
     num_bones = header[3]
     skel_struct = []
-    dat0 = list(struct.unpack("{}{}I".format(e, num_bones), f.read(num_bones * 4))) # list of bones
+    dat0 = read_array(f, 'u4', num_bones, codec) # list of bones
+    if ids_only == True:
+        return([{'id': x} for x in dat0])
     bone_id_dict = {dat0[i]:i for i in range(len(dat0))}
-    dat1 = []
+    dat1 = read_table(f, 'bone', num_bones, codec = codec)
     for i in range(num_bones):
         dat = {'id': dat0[i]}
-        dat1a = struct.unpack("{}6i".format(e), f.read(24))
-        dat['name'] = read_string (f, read_offset(f))
-        offset2 = read_offset(f) # String end offset
-        dat['true_parent'] = dat1a[1]
-        dat['parent'] = bone_id_dict[dat1a[1]] if dat1a[1] in bone_id_dict else dat1a[1] # Maybe should be -1 as default
-        dat1.append(dat1a)
+        dat['name'] = read_string (f, dat1['name_offset'][i])
+        dat['true_parent'] = dat1['parent'][i]
+        dat['parent'] = bone_id_dict[dat1['parent'][i]] if dat1['parent'][i] in bone_id_dict else dat1['parent'][i] # Maybe should be -1 as default
         skel_struct.append(dat)
+    parents = numpy.array([x['parent'] for x in skel_struct], dtype = numpy.int64)
     #Skip giant section of floats, then names of bones
-    f.seek(mtx_offset)
-    inv_mtx = [struct.unpack("{}16f".format(e), f.read(64)) for _ in range(num_bones)] # Stored correctly
-    abs_mtx = [struct.unpack("{}16f".format(e), f.read(64)) for _ in range(num_bones)] # Stored transposed
-    abs_mtx_flip = [numpy.array(abs_mtx[i]).reshape(4,4).flatten('F').tolist() for i in range(len(abs_mtx))] # Column major
+    mtx = numpy.frombuffer(f.view, dtype = get_table_dtype('matrix', codec.e), count = 2 * num_bones,
+        offset = mtx_offset)['matrix'].astype(numpy.float64).reshape(-1,4,4)
+    inv_mtx = mtx[:num_bones] # Stored correctly
+    abs_mtx = mtx[num_bones:].transpose(0,2,1) # Stored transposed
+    local_mtx = compute_local_matrices(abs_mtx, inv_mtx, parents)
+    children = compute_children(parents)
+    abs_mtx, inv_mtx, local_mtx = [x.reshape(-1,16).tolist() for x in [abs_mtx, inv_mtx, local_mtx]]
     for i in range(num_bones):
-        skel_struct[i]['abs_matrix'] = abs_mtx_flip[i]
+        skel_struct[i]['abs_matrix'] = abs_mtx[i] # Column major
         skel_struct[i]['inv_matrix'] = inv_mtx[i]
-    for i in range(len(skel_struct)):
-        if skel_struct[i]['parent'] in range(len(skel_struct)):
-            abs_mtx = [skel_struct[i]['abs_matrix'][0:4], skel_struct[i]['abs_matrix'][4:8],\
-                skel_struct[i]['abs_matrix'][8:12], skel_struct[i]['abs_matrix'][12:16]]
-            parent_inv_mtx = [skel_struct[skel_struct[i]['parent']]['inv_matrix'][0:4],\
-                skel_struct[skel_struct[i]['parent']]['inv_matrix'][4:8],\
-                skel_struct[skel_struct[i]['parent']]['inv_matrix'][8:12],\
-                skel_struct[skel_struct[i]['parent']]['inv_matrix'][12:16]]
-            skel_struct[i]['matrix'] = numpy.dot(abs_mtx, parent_inv_mtx).flatten('C').tolist()
-        else:
-            skel_struct[i]['matrix'] = skel_struct[i]['abs_matrix']
-        skel_struct[i]['children'] = [j for j in range(len(skel_struct)) if skel_struct[j]['parent'] == i]
+        skel_struct[i]['matrix'] = local_mtx[i]
+        skel_struct[i]['children'] = children[i]
     return(skel_struct)
 
-def find_primary_skeleton (missing_bone_palette_ids, base_name = ''):
-    current_endian = e
-    set_endianness('<')
-    if os.path.exists('BASEBONES.DAT'):
-        print("Parsing BASEBONES.DAT for all skeletons.")
-        with open('BASEBONES.DAT', 'rb') as f:
-            magic = f.read(4)
-            if magic == b'TLZC':
-                unc_data = decompress_tlzc(f)
-            elif magic == b'FPS4':
-                f.seek(0)
-                unc_data = f.read()
-        with io.BytesIO(unc_data) as f:
-            set_endianness('<') # Figure out later how to determine this
-            magic = f.read(4)
-            if magic == b'FPS4':
-                header = struct.unpack(">3I2H2I".format(e), f.read(24))
-                toc = []
-                for i in range(header[0]): # entry_stride should be 0x10
-                    toc_entry = struct.unpack(">4I".format(e), f.read(16)) # offset, padded length, true length, name offset
-                    toc_name = read_string(f, toc_entry[3])
-                    toc.append({'name': toc_name, 'offset': toc_entry[0],
-                        'padded_size': toc_entry[2], 'true_size': toc_entry[2]})
-                skel_files = []
-                palettes = {}
-                for i in range(len(toc)):
-                    if toc[i]['true_size'] > 0:
-                        skel = read_skel_section(f, toc[i]['offset'])
-                        palettes[toc[i]['name']] = [x['id'] for x in skel]
-                        skel_files.append(toc[i]['name'])
-            matches = [x for x in skel_files if all([y in palettes[x] for y in missing_bone_palette_ids])]
-            match = ''
-            if not base_name == '' and len(matches) > 1:
-                prefix_matches = [x for x in matches if os.path.basename(x).split('_')[0] == base_name.split('_')[0]]
-                if len(prefix_matches) == 1:
-                    matches = prefix_matches
-            if len(matches) > 1:
-                print("Multiple matches found, please choose one.")
-                for i in range(len(matches)):
-                    print("{0}. {1}".format(i+1, matches[i]))
-                    if (i+1) % 25 == 0:
-                        input("More results, press Enter to continue...")
-                while match == '':
-                    raw_input = input("Use which skeleton? ")
-                    if raw_input.isnumeric() and int(raw_input)-1 in range(len(matches)):
-                        match = matches[int(raw_input)-1]
-                    else:
-                        print("Invalid entry!")
-            elif len(matches) == 1:
-                match = matches[0]
-            if match == '':
-                print("No matches found!")
-            else:
-                print("Using {} as primary skeleton.".format(match))
-            skel_struct = []
-            if not match == '':
-                match_skel = read_skel_section(f, toc[skel_files.index(match)]['offset'])
+# Index of the skeletons in BASEBONES.DAT, {'size', 'mtime', 'skeletons': [{'name', 'offset', 'bone_ids' (sorted)}]}.
+# It is saved next to BASEBONES.DAT (or the .svo archive holding it) and reused for as long as the size
+# and modification time of that file are unchanged.
+def skeleton_index_filename (basebones_file):
+    svo_file, entry_name = split_svo_path(basebones_file)
+    return(svo_file + ('' if entry_name == '' else '.' + entry_name) + '.skeleton_index.json')
+
+def build_skeleton_index (basebones_file):
+    codec = byte_order_codecs['<'] # Figure out later how to determine this
+    skeletons = []
+    with open_mdl_data(basebones_file) as f:
+        magic = f.read(4)
+        if magic == b'FPS4':
+            toc = FPS4Archive(f).entries
+            for i in range(len(toc)):
+                if toc[i]['true_size'] > 0:
+                    skeletons.append({'name': toc[i]['name'], 'offset': toc[i]['offset'],
+                        'bone_ids': sorted([x['id'] for x in read_skel_section(f, toc[i]['offset'], codec, ids_only = True)])})
+    return(skeletons)
+
+@functools.lru_cache(maxsize = 4)
+def read_skeleton_index_cached (basebones_file, size, mtime):
+    index_file = skeleton_index_filename(basebones_file)
+    skeletons = None
+    if os.path.exists(index_file):
+        try:
+            with open(index_file, 'r') as f:
+                skel_index = json.loads(f.read())
+            if skel_index['size'] == size and skel_index['mtime'] == mtime:
+                skeletons = skel_index['skeletons']
+        except (OSError, ValueError, KeyError):
+            pass
+    if skeletons is None:
+        print("Parsing {} for all skeletons.".format(basebones_file))
+        skeletons = build_skeleton_index(basebones_file)
+        try:
+            with open(index_file, 'w') as f:
+                f.write(json.dumps({'size': size, 'mtime': mtime, 'skeletons': skeletons}))
+        except OSError: # Read-only location, the index will be rebuilt next time
+            pass
+    # Inverted index, bone id -> positions in skeletons of the skeletons containing that bone
+    bone_skeletons = {}
+    for i in range(len(skeletons)):
+        for bone_id in skeletons[i]['bone_ids']:
+            bone_skeletons.setdefault(bone_id, set()).add(i)
+    return(skeletons, {x:frozenset(bone_skeletons[x]) for x in bone_skeletons})
+
+# (absolute path, size, mtime) of BASEBONES.DAT, the key of the cached index and skeletons
+def skeleton_index_key (basebones_file):
+    svo_file, entry_name = split_svo_path(basebones_file)
+    file_stat = os.stat(svo_file)
+    basebones_file = os.path.abspath(svo_file) + ('' if entry_name == '' else ':' + entry_name)
+    return(basebones_file, file_stat.st_size, file_stat.st_mtime_ns)
+
+def read_skeleton_index (basebones_file):
+    return(read_skeleton_index_cached(*skeleton_index_key(basebones_file)))
+
+# BASEBONES.DAT is TLZC compressed, so each skeleton is only read (and the file decompressed) once per run
+@functools.lru_cache(maxsize = 16)
+def read_basebones_skeleton_cached (basebones_file, size, mtime, skeleton_name):
+    codec = byte_order_codecs['<'] # Figure out later how to determine this
+    skeletons, bone_skeletons = read_skeleton_index_cached(basebones_file, size, mtime)
+    offset = [x['offset'] for x in skeletons if x['name'] == skeleton_name][0]
+    with open_mdl_data(basebones_file) as f:
+        return(read_skel_section(f, offset, codec))
+
+def read_basebones_skeleton (basebones_file, skeleton_name):
+    # The bones are modified when combined with the model skeleton, so every caller gets its own copy
+    return(copy.deepcopy(read_basebones_skeleton_cached(*skeleton_index_key(basebones_file), skeleton_name)))
+
+# Rules file for picking a skeleton when several match:  a JSON object of model name patterns (as in glob)
+# to skeleton names, e.g. {"EST_*": "PC/EST_C000_BONE.0016"}.  The first pattern matching the model wins.
+def read_skeleton_rules (rules_file):
+    with open(rules_file, 'r') as f:
+        return(json.loads(f.read()))
+
+def choose_skeleton (matches, base_name = '', interactive = True, skeleton_rules = None):
+    match = ''
+    if skeleton_rules is not None and not base_name == '':
+        for pattern in skeleton_rules:
+            if fnmatch.fnmatch(base_name, pattern):
+                rule_matches = [x for x in matches if skeleton_rules[pattern] in [x, os.path.basename(x)]]
+                if len(rule_matches) > 0:
+                    matches = rule_matches[0:1]
+                else:
+                    print("Skeleton {0} from rule {1} does not have all the bones needed, ignoring rule.".format(
+                        skeleton_rules[pattern], pattern))
+                break
+    if not base_name == '' and len(matches) > 1:
+        prefix_matches = [x for x in matches if os.path.basename(x).split('_')[0] == base_name.split('_')[0]]
+        if len(prefix_matches) == 1:
+            matches = prefix_matches
+    if len(matches) > 1 and interactive == False:
+        print("Multiple matches found, using the first one.  Add a skeleton rule to choose another.")
+        match = matches[0]
+    elif len(matches) > 1:
+        print("Multiple matches found, please choose one.")
+        for i in range(len(matches)):
+            print("{0}. {1}".format(i+1, matches[i]))
+            if (i+1) % 25 == 0:
+                input("More results, press Enter to continue...")
+        while match == '':
+            raw_input = input("Use which skeleton? ")
+            if raw_input.isnumeric() and int(raw_input)-1 in range(len(matches)):
+                match = matches[int(raw_input)-1]
             else:
-                match_skel = []
+                print("Invalid entry!")
+    elif len(matches) == 1:
+        match = matches[0]
+    if match == '':
+        print("No matches found!")
+    else:
+        print("Using {} as primary skeleton.".format(match))
+    return(match)
+
+def find_primary_skeleton (missing_bone_palette_ids, base_name = '', basebones_file = 'BASEBONES.DAT',
+        interactive = True, skeleton_rules = None):
+    codec = byte_order_codecs['<'] # Figure out later how to determine this
+    if svo_path_exists(basebones_file):
+        skeletons, bone_skeletons = read_skeleton_index(basebones_file)
+        skel_files = [x['name'] for x in skeletons]
+        # Skeletons with all the missing bones, by intersecting the skeleton sets of each bone
+        candidates = set(range(len(skeletons)))
+        for bone_id in set(missing_bone_palette_ids):
+            candidates &= bone_skeletons.get(bone_id, frozenset())
+        matches = [skel_files[i] for i in sorted(candidates)]
+        match = choose_skeleton(matches, base_name, interactive, skeleton_rules)
+        skel_struct = []
+        if not match == '':
+            match_skel = read_basebones_skeleton(basebones_file, match)
+        else:
+            match_skel = []
     else:
         print("Searching all BONE files for primary skeleton in current folder.")
         skel_files = [x for x in glob.glob('*BONE*') if not 'BASEBONES' in x]
@@ -192,70 +389,61 @@ def find_primary_skeleton (missing_bone_palette_ids, base_name = ''):
             print("This may take a long time...")
         palettes = {}
         for i in range(len(skel_files)):
-            with open(skel_files[i], 'rb') as f:
-                skel = read_skel_section (f, 0)
-                palettes[skel_files[i]] = [x['id'] for x in skel]
-        matches = [x for x in skel_files if all([y in palettes[x] for y in missing_bone_palette_ids])]
-        match = ''
-        if not base_name == '' and len(matches) > 1:
-            prefix_matches = [x for x in matches if os.path.basename(x).split('_')[0] == base_name.split('_')[0]]
-            if len(prefix_matches) == 1:
-                matches = prefix_matches
-        if len(matches) > 1:
-            print("Multiple matches found, please choose one.")
-            for i in range(len(matches)):
-                print("{0}. {1}".format(i+1, matches[i]))
-                if (i+1) % 25 == 0:
-                    input("More results, press Enter to continue...")
-            while match == '':
-                raw_input = input("Use which skeleton? ")
-                if raw_input.isnumeric() and int(raw_input)-1 in range(len(matches)):
-                    match = matches[int(raw_input)-1]
-                else:
-                    print("Invalid entry!")
-        elif len(matches) == 1:
-            match = matches[0]
-        if match == '':
-            print("No matches found!")
-        else:
-            print("Using {} as primary skeleton.".format(match))
+            with open_mdl_data(skel_files[i]) as f:
+                palettes[skel_files[i]] = set([x['id'] for x in read_skel_section (f, 0, codec, ids_only = True)])
+        matches = [x for x in skel_files if palettes[x].issuperset(missing_bone_palette_ids)]
+        match = choose_skeleton(matches, base_name, interactive, skeleton_rules)
         skel_struct = []
         if not match == '':
-            with open(match, 'rb') as f:
-                match_skel = read_skel_section (f, 0)
+            with open_mdl_data(match) as f:
+                match_skel = read_skel_section (f, 0, codec)
         else:
             match_skel = []
-    set_endianness(current_endian) # Restore original endianness
     return match_skel
 
+# Position of each bone id and bone name in the skeleton, for repeated ids / names the first bone is used
+def make_bone_indices (skel_struct):
+    id_index, name_index = {}, {}
+    for i in range(len(skel_struct)):
+        id_index.setdefault(skel_struct[i]['id'], i)
+        name_index.setdefault(skel_struct[i]['name'], i)
+    return(id_index, name_index)
+
+# Skeleton container:  the bone list (skel_struct) with id -> index and name -> index lookups (the first bone wins,
+# as with list.index()), and the absolute / inverse bind matrices as (N,4,4) row major arrays.
+def make_skeleton (skel_struct):
+    skeleton = {'bones': skel_struct}
+    skeleton['id_index'], skeleton['name_index'] = make_bone_indices(skel_struct)
+    skeleton['abs_matrix'] = numpy.array([x['abs_matrix'] for x in skel_struct], dtype = numpy.float64).reshape(-1,4,4)
+    skeleton['inv_matrix'] = numpy.array([x['inv_matrix'] for x in skel_struct], dtype = numpy.float64).reshape(-1,4,4)
+    return(skeleton)
+
+# Indices of bone_ids in the skeleton, -1 for bones that are not in it
+def get_bone_indices (skeleton, bone_ids):
+    return(numpy.array([skeleton['id_index'].get(x, -1) for x in bone_ids], dtype = numpy.int64))
+
 def combine_skeletons (primary_skel_struct, skel_struct):
-    new_skel_struct = primary_skel_struct + skel_struct
+    skeleton = make_skeleton(primary_skel_struct + skel_struct)
+    new_skel_struct = skeleton['bones']
     #Reassign parent
-    new_indices = [x['id'] for x in new_skel_struct]
-    for i in range(len(new_skel_struct)):
-        if new_skel_struct[i]['true_parent'] in new_indices:
-            new_skel_struct[i]['parent'] = new_indices.index(new_skel_struct[i]['true_parent'])
-        else:
-            new_skel_struct[i]['parent'] = -1
+    parents = get_bone_indices(skeleton, [x['true_parent'] for x in new_skel_struct])
+    local_mtx = compute_local_matrices(skeleton['abs_matrix'], skeleton['inv_matrix'], parents).reshape(-1,16).tolist()
+    children = compute_children(parents)
+    parents = parents.tolist()
     for i in range(len(new_skel_struct)):
-        if new_skel_struct[i]['parent'] in range(len(new_skel_struct)):
-            abs_mtx = [new_skel_struct[i]['abs_matrix'][0:4], new_skel_struct[i]['abs_matrix'][4:8],\
-                new_skel_struct[i]['abs_matrix'][8:12], new_skel_struct[i]['abs_matrix'][12:16]]
-            parent_inv_mtx = [new_skel_struct[new_skel_struct[i]['parent']]['inv_matrix'][0:4],\
-                new_skel_struct[new_skel_struct[i]['parent']]['inv_matrix'][4:8],\
-                new_skel_struct[new_skel_struct[i]['parent']]['inv_matrix'][8:12],\
-                new_skel_struct[new_skel_struct[i]['parent']]['inv_matrix'][12:16]]
-            new_skel_struct[i]['matrix'] = numpy.dot(abs_mtx, parent_inv_mtx).flatten('C').tolist()
-        else:
-            new_skel_struct[i]['matrix'] = new_skel_struct[i]['abs_matrix']
-        new_skel_struct[i]['children'] = [j for j in range(len(new_skel_struct)) if new_skel_struct[j]['parent'] == i]
+        new_skel_struct[i]['parent'] = parents[i]
+        new_skel_struct[i]['matrix'] = local_mtx[i]
+        new_skel_struct[i]['children'] = children[i]
     return(new_skel_struct)
 
-def find_and_add_external_skeleton (skel_struct, bone_palette_ids, base_name = ''):
+def find_and_add_external_skeleton (skel_struct, bone_palette_ids, base_name = '', basebones_file = 'BASEBONES.DAT',
+        interactive = True, skeleton_rules = None):
     #Sanity check, if the skeleton is already complete then skip the search
-    if not all([y in [x['id'] for x in skel_struct] for y in bone_palette_ids]):
-        missing_bone_palette_ids = [y for y in bone_palette_ids if not y in [x['id'] for x in skel_struct]]
-        primary_skel_struct = find_primary_skeleton (missing_bone_palette_ids, base_name)
+    skel_ids, _ = make_bone_indices(skel_struct)
+    if not all([y in skel_ids for y in bone_palette_ids]):
+        missing_bone_palette_ids = [y for y in bone_palette_ids if not y in skel_ids]
+        primary_skel_struct = find_primary_skeleton (missing_bone_palette_ids, base_name, basebones_file,
+            interactive, skeleton_rules)
         if len(primary_skel_struct) > 0:
             return(combine_skeletons (primary_skel_struct, skel_struct), primary_skel_struct)
         else:
@@ -302,37 +490,29 @@ def make_fmt(num_uvs, has_weights = True):
     fmt['elements'] = elements
     return(fmt)
 
-def read_mesh (mesh_info, f):
-    def read_floats (f, num):
-        return(list(struct.unpack("{0}{1}f".format(e, num), f.read(num * 4))))
-    def read_bytes (f, num):
-        return(list(struct.unpack("{0}{1}B".format(e, num), f.read(num))))
-    def read_interleaved_floats (f, num, stride, total):
-        vecs = []
-        padding = stride - (num * 4)
-        for i in range(total):
-            vecs.append(read_floats(f, num))
-            f.seek(padding, 1)
-        return(vecs)
-    def read_interleaved_bytes (f, num, stride, total):
-        vecs = []
-        padding = stride - (num)
-        for i in range(total):
-            vecs.append(read_bytes(f, num))
-            f.seek(padding, 1)
-        return(vecs)
+def read_mesh (mesh_info, f, codec = byte_order_codecs['<']):
+    def read_interleaved (f, fields, stride, total):
+        # Strided view over a block of interleaved vertices, fields is a list of (name, format, offset)
+        dtype = numpy.dtype({'names': [x[0] for x in fields], 'formats': [x[1] for x in fields],
+            'offsets': [x[2] for x in fields]})
+        start_offset = f.tell()
+        block = numpy.ndarray((total,), dtype = dtype, buffer = f.view, offset = start_offset, strides = (stride,))
+        f.seek(start_offset + (total * stride))
+        return(block)
+    def read_floats (f, num, total):
+        return(read_interleaved(f, [('vec', (codec.e+'f4', (num,)), 0)], num * 4, total)['vec'])
     def fix_weights (weights):
-        for _ in range(3):
-            weights = [x+[round(1-sum(x),6)] if len(x) < 4 else x for x in weights]
+        while weights.shape[1] < 4:
+            weights = numpy.hstack([weights, numpy.round(1 - weights.sum(axis = 1, keepdims = True), 6)])
         return(weights)
     f.seek(mesh_info['idx_offset'])
-    count, = struct.unpack("{}I".format(e), f.read(4))
+    count, = f.unpack(codec['I'])
     # sub_counts is (number of vertices, number of indices) per count
-    sub_counts = [struct.unpack("{}2H".format(e), f.read(4)) for _ in range(count)]
+    sub_counts = [f.unpack(codec['2H']) for _ in range(count)]
     # Indices
     idx_buffer = []
     for i in range(count):
-        idx_subbuffer = list(struct.unpack("{0}{1}h".format(e, sub_counts[i][1]), f.read(sub_counts[i][1] * 2)))
+        idx_subbuffer = read_array(f, 'i2', sub_counts[i][1], codec)
         if i > 0:
             idx_subbuffer = [x+sum([x[0] for x in sub_counts][0:i]) if not x == -1 else x for x in idx_subbuffer]
         idx_buffer.extend(idx_subbuffer)
@@ -351,171 +531,141 @@ def read_mesh (mesh_info, f):
         total_verts = sum(num_verts)
         for i in range(count): # should always be 1 here I think
             for j in range(len(num_verts)):
-                vert_offset = f.tell()
-                norm_offset = vert_offset + 12
-                blend_idx_offset = norm_offset + 12
-                weights_offset = blend_idx_offset + 4
-                stride = 28 + (j * 4)
-                end_offset = f.tell() + (num_verts[j] * stride)
-                f.seek(vert_offset)
-                verts.extend(read_interleaved_floats(f, 3, stride, num_verts[j]))
-                f.seek(norm_offset)
-                norms.extend(read_interleaved_floats(f, 3, stride, num_verts[j]))
-                f.seek(blend_idx_offset)
+                # Vertices with j+1 weights: position, normal, blend indices, j weights (the last weight is implicit)
+                fields = [('vert', (codec.e+'f4', (3,)), 0), ('norm', (codec.e+'f4', (3,)), 12), ('blend_idx', ('u1', (4,)), 24)]
+                if j > 0:
+                    fields.append(('weights', (codec.e+'f4', (j,)), 28))
+                block = read_interleaved(f, fields, 28 + (j * 4), num_verts[j])
+                verts.append(block['vert'])
+                norms.append(block['norm'])
                 # Blend indices are stored BIG endian, regardless of original endianness
-                blidx = read_interleaved_bytes(f, 4, stride, num_verts[j])
-                if e == '<':
-                    for k in range(len(blidx)):
-                        blidx[k] = blidx[k][::-1]
-                blend_idx.extend(blidx)
+                blend_idx.append(block['blend_idx'][:,::-1] if codec.e == '<' else block['blend_idx'])
                 if j > 0:
-                    f.seek(weights_offset)
-                    weights.extend(read_interleaved_floats(f, j, stride, num_verts[j]))
+                    weights.append(fix_weights(block['weights'].astype(numpy.float64)))
                 else:
-                    weights.extend([[1.0] for _ in range(num_verts[j])])
-                f.seek(end_offset)
-            weights = fix_weights(weights)
+                    weights.append(fix_weights(numpy.ones((num_verts[j], 1))))
             if i < (count - 1):
-                num_verts = struct.unpack("{}4I".format(e), f.read(16))
+                num_verts = f.unpack(codec['4I'])
                 total_verts += sum(num_verts)
     elif mesh_info['flags'] & 0xF00 == 0x400:
         total_verts = mesh_info['total_verts']
-        vert_offset = mesh_info['uv_offset']
-        norm_offset = vert_offset + 12
-        stride = uv_stride
-        f.seek(vert_offset)
-        verts.extend(read_interleaved_floats(f, 3, stride, total_verts))
-        f.seek(norm_offset)
-        norms.extend(read_interleaved_floats(f, 3, stride, total_verts))
+        f.seek(mesh_info['uv_offset'])
+        block = read_interleaved(f, [('vert', (codec.e+'f4', (3,)), 0), ('norm', (codec.e+'f4', (3,)), 12)],
+            uv_stride, total_verts)
+        verts.append(block['vert'])
+        norms.append(block['norm'])
     elif mesh_info['flags'] & 0xF00 == 0x700:
         # No weights, so only mesh_info['num_verts'][0] is non-zero
         total_verts = sum(mesh_info['num_verts'])
-        vert_offset = f.tell()
-        verts.extend([read_floats(f, 3) for _ in range(total_verts)])
-        norms.extend([read_floats(f, 3) for _ in range(total_verts)])
+        verts.append(read_floats(f, 3, total_verts))
+        norms.append(read_floats(f, 3, total_verts))
+    # Copied into native byte order arrays, so nothing refers back to the file data
+    verts = numpy.concatenate(verts).astype(numpy.float32) if len(verts) > 0 else numpy.zeros((0, 3), dtype = numpy.float32)
+    norms = numpy.concatenate(norms).astype(numpy.float32) if len(norms) > 0 else numpy.zeros((0, 3), dtype = numpy.float32)
     uv_maps = []
     if mesh_info['flags'] & 0xF00 in [0x100, 0x700]:
-        for i in range(num_uv_maps):
-            f.seek(mesh_info['uv_offset'] + 4 + (i * 8))
-            uv_maps.append(read_interleaved_floats (f, 2, uv_stride, total_verts))
+        uv_start = mesh_info['uv_offset'] + 4
     elif mesh_info['flags'] & 0xF00 == 0x400:
-        for i in range(num_uv_maps):
-            f.seek(mesh_info['uv_offset'] + 28 + (i * 8))
-            uv_maps.append(read_interleaved_floats (f, 2, uv_stride, total_verts))
+        uv_start = mesh_info['uv_offset'] + 28
+    if mesh_info['flags'] & 0xF00 in [0x100, 0x400, 0x700] and num_uv_maps > 0:
+        f.seek(uv_start)
+        block = read_interleaved(f, [('uv', (codec.e+'f4', (num_uv_maps, 2)), 0)], uv_stride, total_verts)
+        uv_maps = [block['uv'][:,i].astype(numpy.float32) for i in range(num_uv_maps)]
     fmt = make_fmt(len(uv_maps), True)
     vb = [{'Buffer': verts}, {'Buffer': norms}]
     for uv_map in uv_maps:
         vb.append({'Buffer': uv_map})
     if mesh_info['flags'] & 0xF00 == 0x100:
-        vb.append({'Buffer': weights})
-        vb.append({'Buffer': blend_idx})
+        vb.append({'Buffer': numpy.concatenate(weights)})
+        vb.append({'Buffer': numpy.concatenate(blend_idx).astype(numpy.uint8)})
     elif mesh_info['flags'] & 0xF00 in [0x400, 0x700]:
-        vb.append({'Buffer': [[1.0, 0.0, 0.0, 0.0] for _ in range(len(verts))]})
-        vb.append({'Buffer': [[0, 0, 0, 0] for _ in range(len(verts))]})
+        vb.append({'Buffer': numpy.tile([1.0, 0.0, 0.0, 0.0], (len(verts), 1))})
+        vb.append({'Buffer': numpy.zeros((len(verts), 4), dtype = numpy.uint8)})
     return({'fmt': fmt, 'vb': vb, 'ib': trianglestrip_to_list(idx_buffer)})
 
-def read_mesh_section (f, start_offset, uv_start_offset):
+def read_mesh_section (f, start_offset, uv_start_offset, codec = byte_order_codecs['<']):
     f.seek(start_offset)
-    header = struct.unpack("{}9I".format(e), f.read(36)) #unk0, size, unk1, num_meshes, palette_count, unknown * 4
+    header = f.unpack(codec['9I']) #unk0, size, unk1, num_meshes, palette_count, unknown * 4
     num_meshes = header[3]
     palette_count = header[4]
-    bounding_sphere, num_verts = [],[]
-    for _ in range(num_meshes):
-        bounding_sphere.append(struct.unpack("{}4f".format(e), f.read(16)))
-        num_verts.append(struct.unpack("{}4I".format(e), f.read(16)))
-    dat1 = [struct.unpack("{}4f".format(e), f.read(16)) for _ in range(num_meshes)]
+    bounding_sphere = read_table(f, 'bounding_sphere', num_meshes, codec = codec) # Also has the number of vertices per weight group
+    dat1 = read_table(f, 'mesh_unk', num_meshes, codec = codec)
+    val = read_table(f, 'mesh_header', num_meshes, codec = codec)
     mesh_blocks_info = []
     for i in range(num_meshes):
-        flags, = struct.unpack("{}I".format(e), f.read(4))
-        val1 = struct.unpack("{}4I".format(e), f.read(16)) # start of v1 - mesh, submesh, node, material
-        uv_offset, = struct.unpack("{}I".format(e), f.read(4))
-        idx_offset = read_offset(f)
-        vert_offset = read_offset(f)
-        val2 = struct.unpack("{}5I".format(e), f.read(20)) # start of v2 - uv_stride, flags2, #verts, #idx, a zero
-        name = read_string(f, read_offset(f))
-        name_end_offset = read_offset(f)
-        dat = {'flags': flags, 'name': name, 'mesh': val1[0], 'submesh': val1[1], 'node': val1[2],
-            'material_id': val1[3], 'uv_offset': uv_offset + uv_start_offset, 'idx_offset': idx_offset,
-            'vert_offset': vert_offset, 'bounding_sphere_center': bounding_sphere[i][0:3],
-            'bounding_sphere_radius': bounding_sphere[i][3], 'unk_fltarr': dat1[i],
-            'num_verts': num_verts[i], 'uv_stride': val2[0], 'flags2': val2[1],
-            'total_verts': val2[2], 'total_idx': val2[3], 'unk': val2[4]}
+        dat = {'flags': val['flags'][i], 'name': read_string(f, val['name_offset'][i]), 'mesh': val['mesh'][i],
+            'submesh': val['submesh'][i], 'node': val['node'][i], 'material_id': val['material_id'][i],
+            'uv_offset': val['uv_offset'][i] + uv_start_offset, 'idx_offset': val['idx_offset'][i],
+            'vert_offset': val['vert_offset'][i], 'bounding_sphere_center': bounding_sphere['center'][i],
+            'bounding_sphere_radius': bounding_sphere['radius'][i], 'unk_fltarr': dat1['unk_fltarr'][i],
+            'num_verts': bounding_sphere['num_verts'][i], 'uv_stride': val['uv_stride'][i], 'flags2': val['flags2'][i],
+            'total_verts': val['total_verts'][i], 'total_idx': val['total_idx'][i], 'unk': val['unk'][i]}
         mesh_blocks_info.append(dat)
-    bone_palette_ids = struct.unpack("{}{}I".format(e, palette_count), f.read(4 * palette_count))
+    bone_palette_ids = read_array(f, 'u4', palette_count, codec)
     meshes = []
     for i in range(num_meshes):
-        meshes.append(read_mesh(mesh_blocks_info[i], f))
+        meshes.append(read_mesh(mesh_blocks_info[i], f, codec))
     return(meshes, bone_palette_ids, mesh_blocks_info)
 
 def repair_mesh_weights (meshes, bone_palette_ids, skel_struct):
-    used_groups_buffer = []
-    for i in range(len(meshes)):
-        for j in range(len(meshes[i]['vb'][0]['Buffer'])):
-            total, k = 0.0, 0
-            while total < 1.0 and k < 4:
-                total += meshes[i]['vb'][-2]['Buffer'][j][k]
-                k += 1
-            used_groups_buffer.extend(meshes[i]['vb'][-1]['Buffer'][j][:k])
-    used_groups = sorted(list(set(used_groups_buffer)))
-    new_palette_ids = [bone_palette_ids[i] for i in range(len(bone_palette_ids)) if i in used_groups]
-    if all([y in [x['id'] for x in skel_struct] for y in new_palette_ids]):
-        old_to_new = {used_groups[i]:i for i in range(len(used_groups))}
+    def used_influences (weights):
+        # Influences are read in order until the weights add up to 1.0
+        below_one = numpy.logical_and.accumulate(numpy.cumsum(weights, axis = 1) < 1.0, axis = 1)
+        return(numpy.hstack([numpy.ones((len(weights), 1), dtype = bool), below_one[:,:-1]]))
+    weights = [numpy.asarray(x['vb'][-2]['Buffer'], dtype = numpy.float64).reshape(-1, 4) for x in meshes]
+    blend_idx = [numpy.asarray(x['vb'][-1]['Buffer'], dtype = numpy.int64).reshape(-1, 4) for x in meshes]
+    used = [used_influences(x) for x in weights]
+    used_groups = numpy.unique(numpy.concatenate([numpy.zeros(0, dtype = numpy.int64)]
+        + [blend_idx[i][used[i]] for i in range(len(meshes))]))
+    new_palette_ids = [bone_palette_ids[i] for i in used_groups.tolist() if i < len(bone_palette_ids)]
+    skel_ids, _ = make_bone_indices(skel_struct)
+    if all([y in skel_ids for y in new_palette_ids]):
+        old_to_new = numpy.zeros(used_groups[-1] + 1 if len(used_groups) > 0 else 1, dtype = numpy.int64)
+        old_to_new[used_groups] = numpy.arange(len(used_groups))
         for i in range(len(meshes)):
-            new_wt_buffer = []
-            for j in range(len(meshes[i]['vb'][0]['Buffer'])):
-                new_wt = []
-                total, k = 0.0, 0
-                while total < 1.0 and k < 4:
-                    total += meshes[i]['vb'][-2]['Buffer'][j][k]
-                    new_wt.append(old_to_new[meshes[i]['vb'][-1]['Buffer'][j][k]])
-                    k += 1
-                while k < 4:
-                    new_wt.append(0)
-                    k += 1
-                new_wt_buffer.append(new_wt)
-            meshes[i]['vb'][-1]['Buffer'] = new_wt_buffer
+            new_blend_idx = old_to_new[numpy.where(used[i], blend_idx[i], 0)]
+            meshes[i]['vb'][-1]['Buffer'] = numpy.where(used[i], new_blend_idx, 0).astype(numpy.uint8)
         return(meshes, new_palette_ids)
     else:
         return(meshes, bone_palette_ids) # Could not remap, return original values
 
-def read_material_section (f, start_offset):
+def read_material_section (f, start_offset, codec = byte_order_codecs['<']):
     f.seek(start_offset)
-    header = struct.unpack("{}5I".format(e), f.read(20)) #unk0, size, unk1, num_mats, maybe num_tex?
+    header = f.unpack(codec['5I']) #unk0, size, unk1, num_mats, maybe num_tex?
     num_materials = header[3]
-    set_0 = []
+    # Each of the 3 sets has a fixed record per material, followed by one record per texture of that material
+    set_0_offsets = []
     for _ in range(num_materials):
-        num_tex, internal_id = struct.unpack("{}2i".format(e), f.read(8))
-        s0_struct = {'base': struct.unpack("{}if4i".format(e), f.read(24)), 'tex': []}
-        for _ in range(num_tex):
-            s0_struct['tex'].append(struct.unpack("{}2i".format(e), f.read(8)))
-        set_0.append({'num_tex': num_tex, 'internal_id': internal_id, 's0_struct': s0_struct})
-    set_1 = []
-    for i in range(num_materials):
-        unk1, = struct.unpack("{}I".format(e), f.read(4))
-        name = read_string(f, read_offset(f))
-        end_offset = read_offset(f)
-        unk2, = struct.unpack("{}I".format(e), f.read(4))
-        tex_names, tex_vals = [], []
-        for _ in range(set_0[i]['num_tex']):
-            tex_name = read_string(f, read_offset(f))
-            tex_val, = struct.unpack("{}I".format(e), f.read(4))
-            tex_names.append(tex_name)
-            tex_vals.append(tex_val)
-        set_1.append({'name': name, 'tex_names': tex_names, 's1_struct': {'base': [unk1, unk2], 'tex': tex_vals}})
-    set_2 = []
-    for i in range(num_materials):
-        s2_struct = {'base_floats': struct.unpack("{}4f".format(e), f.read(16)), 'tex_floats': []}
-        for _ in range(set_0[i]['num_tex']):
-            s2_struct['tex_floats'].append(struct.unpack("{}6f".format(e), f.read(24)))
-        set_2.append(s2_struct)
+        set_0_offsets.append(f.tell())
+        num_tex, = f.unpack(codec['i'])
+        f.seek(28 + (num_tex * 8), 1)
+    set_0 = read_table(f, 'material', offsets = set_0_offsets, codec = codec)
+    num_tex = numpy.array(set_0['num_tex'], dtype = numpy.int64)
+    set_0_tex = read_table(f, 'material_tex', offsets = ragged_offsets(numpy.array(set_0_offsets) + 32, num_tex, 8),
+        codec = codec)
+    set_1_sizes = 16 + (num_tex * 8)
+    set_1_offsets = f.tell() + numpy.cumsum(set_1_sizes) - set_1_sizes
+    set_1 = read_table(f, 'material_name', offsets = set_1_offsets, codec = codec)
+    set_1_tex = read_table(f, 'material_tex_name', offsets = ragged_offsets(set_1_offsets + 16, num_tex, 8), codec = codec)
+    f.seek(f.tell() + int(set_1_sizes.sum()))
+    set_2_sizes = 16 + (num_tex * 24)
+    set_2_offsets = f.tell() + numpy.cumsum(set_2_sizes) - set_2_sizes
+    set_2 = read_table(f, 'material_floats', offsets = set_2_offsets, codec = codec)
+    set_2_tex = read_table(f, 'material_tex_floats', offsets = ragged_offsets(set_2_offsets + 16, num_tex, 24),
+        codec = codec)
+    f.seek(f.tell() + int(set_2_sizes.sum()))
+    tex_start = numpy.concatenate([[0], numpy.cumsum(num_tex)]).tolist()
     material_struct = []
-    if len(set_0) == len(set_1):
-        for i in range(len(set_0)):
-            material = {'name': set_1[i]['name']}
-            material['textures'] = set_1[i]['tex_names']
-            material['internal_id'] = set_0[i]['internal_id']
-            material['unk_parameters'] = {'set_0': set_0[i]['s0_struct'], 'set_1': set_1[i]['s1_struct'], 'set_2': set_2[i]}
-            material_struct.append(material)
+    for i in range(num_materials):
+        tex = slice(tex_start[i], tex_start[i+1])
+        material = {'name': read_string(f, set_1['name_offset'][i])}
+        material['textures'] = [read_string(f, x) for x in set_1_tex['name_offset'][tex]]
+        material['internal_id'] = set_0['internal_id'][i]
+        material['unk_parameters'] = {'set_0': {'base': [set_0['base_0'][i], set_0['base_1'][i]] + set_0['base_2'][i],
+            'tex': set_0_tex['tex'][tex]}, 'set_1': {'base': [set_1['unk1'][i], set_1['unk2'][i]],
+            'tex': set_1_tex['tex_val'][tex]}, 'set_2': {'base_floats': set_2['base_floats'][i],
+            'tex_floats': set_2_tex['tex_floats'][tex]}}
+        material_struct.append(material)
     return (material_struct)
 
 def material_id_to_index (mesh_blocks_info, material_struct, offset):
@@ -525,46 +675,29 @@ def material_id_to_index (mesh_blocks_info, material_struct, offset):
     return(mesh_blocks_info)
 
 def read_texture_section (f, start_offset, tex_data_offset):
-    current_endian = e
-    set_endianness('>') # This section is in big endian, and most of the data is actually wrong
+    # This section is in big endian, and most of the data is actually wrong
     f.seek(start_offset)
-    header = struct.unpack("{}6I".format(e), f.read(24)) #unk0, size, unk1, num_tex, unk, unk
+    header = f.unpack(byte_order_codecs['>']['6I']) #unk0, size, unk1, num_tex, unk, unk
+    data = read_table(f, 'texture', header[3], codec = byte_order_codecs['>'])
     tex_data = []
-    for _ in range(header[3]):
-        data = struct.unpack("{}4i".format(e), f.read(16))
-        name = read_string(f, read_offset(f))
-        tex_offset, = struct.unpack("{}I".format(e), f.read(4))
-        unk, = struct.unpack("{}I".format(e), f.read(4))
-        tex_data.append({'name': name, 'dwWidth': data[0], 'dwHeight': data[1], 'dwMipMapCount': data[2],
-            'type': data[3], 'offset': tex_offset + tex_data_offset, 'unk': unk})
-    set_endianness(current_endian) # Restore original endianness
+    for i in range(header[3]):
+        tex_data.append({'name': read_string(f, data['name_offset'][i]), 'dwWidth': data['dwWidth'][i],
+            'dwHeight': data['dwHeight'][i], 'dwMipMapCount': data['dwMipMapCount'][i], 'type': data['type'][i],
+            'offset': data['offset'][i] + tex_data_offset, 'unk': data['unk'][i]})
     return(tex_data)
 
 def convert_format_for_gltf(dxgi_format):
-    dxgi_format = dxgi_format.split('DXGI_FORMAT_')[-1]
-    dxgi_format_split = dxgi_format.split('_')
-    if len(dxgi_format_split) == 2:
-        numtype = dxgi_format_split[1]
-        vec_format = re.findall("[0-9]+",dxgi_format_split[0])
-        vec_bits = int(vec_format[0])
-        vec_elements = len(vec_format)
-        if numtype in ['FLOAT', 'UNORM', 'SNORM']:
-            componentType = 5126
-            componentStride = len(re.findall('[0-9]+', dxgi_format)) * 4
-            dxgi_format = "".join(['R32','G32','B32','A32','D32'][0:componentStride//4]) + "_FLOAT"
-        elif numtype == 'UINT':
-            if vec_bits == 32:
-                componentType = 5125
-                componentStride = len(re.findall('[0-9]+', dxgi_format)) * 4
-            elif vec_bits == 16:
-                componentType = 5123
-                componentStride = len(re.findall('[0-9]+', dxgi_format)) * 2
-            elif vec_bits == 8:
-                componentType = 5121
-                componentStride = len(re.findall('[0-9]+', dxgi_format))
+    dxgi_format = get_dxgi_format(dxgi_format)
+    if dxgi_format.numtype != 'UNSUPPORTED':
+        if dxgi_format.numtype in ['FLOAT', 'UNORM', 'SNORM']:
+            componentStride = dxgi_format.elements * 4
+            gltf_format = "".join(['R32','G32','B32','A32','D32'][0:dxgi_format.elements]) + "_FLOAT"
+        elif dxgi_format.numtype == 'UINT':
+            componentStride = dxgi_format.stride
+            gltf_format = dxgi_format.format
         accessor_types = ["SCALAR", "VEC2", "VEC3", "VEC4"]
-        accessor_type = accessor_types[len(re.findall('[0-9]+', dxgi_format))-1]
-        return({'format': dxgi_format, 'componentType': componentType,\
+        accessor_type = accessor_types[dxgi_format.elements-1]
+        return({'format': gltf_format, 'componentType': dxgi_format.gltf_component_type,\
             'componentStride': componentStride, 'accessor_type': accessor_type})
     else:
         return(False)
@@ -603,8 +736,39 @@ def fix_strides(submesh):
         offset += submesh['vb'][i]['stride']
     return(submesh)
 
-def write_gltf(base_name, skel_struct, vgmaps, mesh_blocks_info, meshes, material_struct,\
-        overwrite = False, write_binary_gltf = True):
+# The binary buffer of a glTF is kept as a list of blocks, which are only written out at the end by
+# write_gltf_buffer(), instead of being concatenated in memory.  Returns the byte offset of the new block.
+def add_gltf_buffer_block(gltf_buffer, data, alignment = 1):
+    offset = gltf_buffer['byteLength']
+    padding = (-len(data)) % alignment
+    gltf_buffer['blocks'].append(data)
+    if padding > 0:
+        gltf_buffer['blocks'].append(b'\x00' * padding)
+    gltf_buffer['byteLength'] += len(data) + padding
+    return(offset)
+
+def write_gltf_buffer(f, gltf_buffer):
+    for block in gltf_buffer['blocks']:
+        f.write(block)
+    return
+
+# Accessor for an array-backed attribute, with the count taken from the array shape.  Vector / matrix
+# accessors count rows, scalar accessors count every value (so an (N,3) index buffer counts 3N indices).
+# bounds = True adds the min / max that glTF requires for POSITION.
+def build_gltf_accessor(buffer_view, component_type, accessor_type, data, bounds = False):
+    components = {'SCALAR': 1, 'VEC2': 2, 'VEC3': 3, 'VEC4': 4, 'MAT4': 16}[accessor_type]
+    data = numpy.asarray(data)
+    count = data.size if (accessor_type == 'SCALAR' or data.ndim < 2) else data.shape[0]
+    accessor = {"bufferView" : buffer_view, "componentType": component_type, "count": count, "type": accessor_type}
+    if bounds == True:
+        column = data.reshape(count, -1)[:,0:components]
+        accessor['max'] = column.max(axis = 0).tolist()
+        accessor['min'] = column.min(axis = 0).tolist()
+    return(accessor)
+
+def write_gltf(base_name, skeleton, vgmaps, mesh_blocks_info, meshes, material_struct,\
+        overwrite = False, write_binary_gltf = True, interactive = True):
+    skel_struct = skeleton['bones']
     gltf_data = {}
     gltf_data['asset'] = { 'version': '2.0' }
     gltf_data['accessors'] = []
@@ -619,8 +783,7 @@ def write_gltf(base_name, skel_struct, vgmaps, mesh_blocks_info, meshes, materia
     gltf_data['scene'] = 0
     gltf_data['skins'] = []
     gltf_data['textures'] = []
-    giant_buffer = bytes()
-    buffer_view = 0
+    gltf_buffer = {'blocks': [], 'byteLength': 0}
     # Materials
     material_dict = [{'name': material_struct[i]['name'],
         'texture': material_struct[i]['textures'][0] if len(material_struct[i]['textures']) > 0 else '',
@@ -656,31 +819,32 @@ def write_gltf(base_name, skel_struct, vgmaps, mesh_blocks_info, meshes, materia
     if len(gltf_data['nodes']) == 0:
         gltf_data['nodes'].append({'children': [], 'name': 'root'})
     # Mesh nodes will be attached to the first node since in the original model, they don't really have a home
-    node_id_list = [x['id'] for x in skel_struct]
     for i in range(len(mesh_blocks_info)):
         mesh_blocks_info[i]['mesh_v'] = '{0}_{1:02d}'.format(mesh_blocks_info[i]['mesh'], mesh_blocks_info[i]['vgmap'])
     if not 'children' in gltf_data['nodes'][0]:
         gltf_data['nodes'][0]['children'] = []
     mesh_node_ids = {x['mesh_v']:x['name'] for x in mesh_blocks_info}
     for mesh_node_id in mesh_node_ids:
-        if not mesh_node_id in node_id_list:
+        if not mesh_node_id in skeleton['id_index']:
             g_node = {'name': mesh_node_ids[mesh_node_id]}
             gltf_data['nodes'][0]['children'].append(len(gltf_data['nodes']))
             gltf_data['nodes'].append(g_node)
     mesh_block_tree = {x:[i for i in range(len(mesh_blocks_info)) if mesh_blocks_info[i]['mesh_v'] == x] for x in mesh_node_ids}
-    node_list = [x['name'] for x in gltf_data['nodes']]
+    node_index = dict(skeleton['name_index'])
+    for i in range(len(skel_struct), len(gltf_data['nodes'])):
+        node_index.setdefault(gltf_data['nodes'][i]['name'], i)
     # Skin matrices
     skinning_possible = True
     try:
         ibms_struct = []
         inv_mtx_buffers = []
         for vgmap in vgmaps:
-            vgmap_nodes = [node_list.index(x) for x in list(vgmap.keys())]
+            vgmap_nodes = [node_index[x] for x in list(vgmap.keys())]
             ibms = [skel_struct[j]['inv_matrix'] for j in vgmap_nodes]
             inv_mtx_buffer = b''.join([struct.pack("<16f", *x) for x in ibms])
             ibms_struct.append(ibms)
             inv_mtx_buffers.append(inv_mtx_buffer)
-    except ValueError:
+    except KeyError:
         skinning_possible = False
     # Meshes
     mesh_names = [] # Xillia doesn't have a 
@@ -692,24 +856,16 @@ def write_gltf(base_name, skel_struct, vgmaps, mesh_blocks_info, meshes, materia
             gltf_fmt = convert_fmt_for_gltf(meshes[i]['fmt'])
             vb_stream = io.BytesIO()
             write_vb_stream(meshes[i]['vb'], vb_stream, gltf_fmt, e='<', interleave = False)
-            block_offset = len(giant_buffer)
+            block_offset = add_gltf_buffer_block(gltf_buffer, vb_stream.getvalue())
+            vb_stream.close()
             primitive = {"attributes":{}}
             for element in range(len(gltf_fmt['elements'])):
                 primitive["attributes"][gltf_fmt['elements'][element]['SemanticName']]\
                     = len(gltf_data['accessors'])
-                gltf_data['accessors'].append({"bufferView" : len(gltf_data['bufferViews']),\
-                    "componentType": gltf_fmt['elements'][element]['componentType'],\
-                    "count": len(meshes[i]['vb'][element]['Buffer']),\
-                    "type": gltf_fmt['elements'][element]['accessor_type']})
-                if gltf_fmt['elements'][element]['SemanticName'] == 'POSITION':
-                    gltf_data['accessors'][-1]['max'] =\
-                        [max([x[0] for x in meshes[i]['vb'][element]['Buffer']]),\
-                         max([x[1] for x in meshes[i]['vb'][element]['Buffer']]),\
-                         max([x[2] for x in meshes[i]['vb'][element]['Buffer']])]
-                    gltf_data['accessors'][-1]['min'] =\
-                        [min([x[0] for x in meshes[i]['vb'][element]['Buffer']]),\
-                         min([x[1] for x in meshes[i]['vb'][element]['Buffer']]),\
-                         min([x[2] for x in meshes[i]['vb'][element]['Buffer']])]
+                gltf_data['accessors'].append(build_gltf_accessor(len(gltf_data['bufferViews']),\
+                    gltf_fmt['elements'][element]['componentType'], gltf_fmt['elements'][element]['accessor_type'],\
+                    meshes[i]['vb'][element]['Buffer'],\
+                    bounds = (gltf_fmt['elements'][element]['SemanticName'] == 'POSITION')))
                 gltf_data['bufferViews'].append({"buffer": 0,\
                     "byteOffset": block_offset,\
                     "byteLength": len(meshes[i]['vb'][element]['Buffer']) *\
@@ -717,71 +873,63 @@ def write_gltf(base_name, skel_struct, vgmaps, mesh_blocks_info, meshes, materia
                     "target" : 34962})
                 block_offset += len(meshes[i]['vb'][element]['Buffer']) *\
                     gltf_fmt['elements'][element]['componentStride']
-            vb_stream.seek(0)
-            giant_buffer += vb_stream.read()
-            vb_stream.close()
-            del(vb_stream)
             # Index Buffers
             ib_stream = io.BytesIO()
             write_ib_stream(meshes[i]['ib'], ib_stream, gltf_fmt, e='<')
             # IB is 16-bit so can be misaligned, unlike VB
-            while (ib_stream.tell() % 4) > 0:
-                ib_stream.write(b'\x00')
+            block_offset = add_gltf_buffer_block(gltf_buffer, ib_stream.getvalue(), alignment = 4)
+            ib_stream.close()
             primitive["indices"] = len(gltf_data['accessors'])
-            gltf_data['accessors'].append({"bufferView" : len(gltf_data['bufferViews']),\
-                "componentType": gltf_fmt['componentType'],\
-                "count": len([index for triangle in meshes[i]['ib'] for index in triangle]),\
-                "type": gltf_fmt['accessor_type']})
+            gltf_data['accessors'].append(build_gltf_accessor(len(gltf_data['bufferViews']),\
+                gltf_fmt['componentType'], gltf_fmt['accessor_type'], meshes[i]['ib']))
             gltf_data['bufferViews'].append({"buffer": 0,\
-                "byteOffset": len(giant_buffer),\
-                "byteLength": ib_stream.tell(),\
+                "byteOffset": block_offset,\
+                "byteLength": gltf_buffer['byteLength'] - block_offset,\
                 "target" : 34963})
-            ib_stream.seek(0)
-            giant_buffer += ib_stream.read()
-            ib_stream.close()
-            del(ib_stream)
             primitive["mode"] = 4 #TRIANGLES
             primitive["material"] = mesh_blocks_info[i]['material']
             primitives.append(primitive)
         if len(primitives) > 0:
-            if mesh_node_ids[mesh] in node_list: # One of the new nodes
-                node_id = node_list.index(mesh_node_ids[mesh])
+            if mesh_node_ids[mesh] in node_index: # One of the new nodes
+                node_id = node_index[mesh_node_ids[mesh]]
             else: # One of the pre-assigned nodes
-                node_id = node_id_list.index(mesh_blocks_info[i]["mesh_v"])
+                node_id = skeleton['id_index'][mesh_blocks_info[i]["mesh_v"]]
             gltf_data['nodes'][node_id]['mesh'] = len(gltf_data['meshes'])
             gltf_data['meshes'].append({"primitives": primitives, "name": mesh_node_ids[mesh]})
             # Skinning
             if len(vgmaps[mesh_blocks_info[i]["vgmap"]]) > 0 and skinning_possible == True:
                 gltf_data['nodes'][node_id]['skin'] = len(gltf_data['skins'])
                 gltf_data['skins'].append({"inverseBindMatrices": len(gltf_data['accessors']),\
-                    "joints": [node_list.index(x) for x in vgmaps[mesh_blocks_info[i]["vgmap"]]]})
-                gltf_data['accessors'].append({"bufferView" : len(gltf_data['bufferViews']),\
-                    "componentType": 5126,\
-                    "count": len(ibms_struct[mesh_blocks_info[i]["vgmap"]]),\
-                    "type": "MAT4"})
+                    "joints": [node_index[x] for x in vgmaps[mesh_blocks_info[i]["vgmap"]]]})
+                gltf_data['accessors'].append(build_gltf_accessor(len(gltf_data['bufferViews']),\
+                    5126, "MAT4", ibms_struct[mesh_blocks_info[i]["vgmap"]]))
                 gltf_data['bufferViews'].append({"buffer": 0,\
-                    "byteOffset": len(giant_buffer),\
+                    "byteOffset": add_gltf_buffer_block(gltf_buffer, inv_mtx_buffers[mesh_blocks_info[i]["vgmap"]]),\
                     "byteLength": len(inv_mtx_buffers[mesh_blocks_info[i]["vgmap"]])})
-                giant_buffer += inv_mtx_buffers[mesh_blocks_info[i]["vgmap"]]
     # Write GLB
-    gltf_data['buffers'].append({"byteLength": len(giant_buffer)})
+    gltf_data['buffers'].append({"byteLength": gltf_buffer['byteLength']})
     if (os.path.exists(base_name + '.gltf') or os.path.exists(base_name + '.glb')) and (overwrite == False):
-        if str(input(base_name + ".glb/.gltf exists! Overwrite? (y/N) ")).lower()[0:1] == 'y':
+        if interactive == False:
+            print("{}.glb/.gltf exists, skipping.".format(base_name))
+        elif str(input(base_name + ".glb/.gltf exists! Overwrite? (y/N) ")).lower()[0:1] == 'y':
             overwrite = True
     if (overwrite == True) or not (os.path.exists(base_name + '.gltf') or os.path.exists(base_name + '.glb')):
         if write_binary_gltf == True:
             with open(base_name+'.glb', 'wb') as f:
                 jsondata = json.dumps(gltf_data).encode('utf-8')
                 jsondata += b' ' * (4 - len(jsondata) % 4)
-                f.write(struct.pack('<III', 1179937895, 2, 12 + 8 + len(jsondata) + 8 + len(giant_buffer)))
+                bin_padding = (-gltf_buffer['byteLength']) % 4
+                bin_length = gltf_buffer['byteLength'] + bin_padding
+                f.write(struct.pack('<III', 1179937895, 2, 12 + 8 + len(jsondata) + 8 + bin_length))
                 f.write(struct.pack('<II', len(jsondata), 1313821514))
                 f.write(jsondata)
-                f.write(struct.pack('<II', len(giant_buffer), 5130562))
-                f.write(giant_buffer)
+                f.write(struct.pack('<II', bin_length, 5130562))
+                write_gltf_buffer(f, gltf_buffer)
+                f.write(b'\x00' * bin_padding)
         else:
             gltf_data['buffers'][0]["uri"] = base_name+'.bin'
             with open(base_name+'.bin', 'wb') as f:
-                f.write(giant_buffer)
+                write_gltf_buffer(f, gltf_buffer)
             with open(base_name+'.gltf', 'wb') as f:
                 f.write(json.dumps(gltf_data, indent=4).encode("utf-8"))
 
@@ -789,18 +937,18 @@ def write_fps4_with_names (fps4_struct):
     header_sz = 0x1c + (0x10 * (len(fps4_struct) + 1))
     name_block_sz = len(b'\x00'.join([x['name'].encode('utf-8') for x in fps4_struct]))
     head_block_sz = round_up_align(header_sz + name_block_sz, 0x10)
-    header_block = bytearray(b'FPS4' + struct.pack(">3I2H2I".format(e), len(fps4_struct) + 1,
+    header_block = bytearray(b'FPS4' + struct.pack(">3I2H2I", len(fps4_struct) + 1,
         0x1c, head_block_sz, 0x10, 0x47, 0, 0))
     name_block = bytearray()
     data_block = bytearray()
     model = ''
     ii = 0
     for i in range(len(fps4_struct)):
-        header_block.extend(struct.pack(">4i".format(e), head_block_sz + len(data_block),
+        header_block.extend(struct.pack(">4i", head_block_sz + len(data_block),
             len(fps4_struct[i]['data']), len(fps4_struct[i]['data']), header_sz + len(name_block)))
         data_block.extend(fps4_struct[i]['data'])
         name_block.extend(fps4_struct[i]['name'].encode('utf-8') + b'\x00')
-    header_block.extend(struct.pack(">4i".format(e), -1, 0, 0, 0)) # Padding
+    header_block.extend(struct.pack(">4i", -1, 0, 0, 0)) # Padding
     fps4 = bytearray(header_block+name_block)
     while len(fps4) % 0x10 > 0:
         fps4.extend(b'\x00')
@@ -808,67 +956,52 @@ def write_fps4_with_names (fps4_struct):
     return(fps4)
 
 def write_fps4_shell_type (fps4_blocks, shell_name = ''):
-    header_block = bytearray(b'FPS4' + struct.pack(">3I2H2I".format(e), len(fps4_blocks) + 1,
+    header_block = bytearray(b'FPS4' + struct.pack(">3I2H2I", len(fps4_blocks) + 1,
         0x1c, 0x80, 0xC, 0x7, 0, (0x1c + (0xC * (len(fps4_blocks) + 1)))))
     data_block = bytearray()
     for i in range(len(fps4_blocks)):
-        header_block.extend(struct.pack(">3i".format(e), 0x80 + len(data_block),
+        header_block.extend(struct.pack(">3i", 0x80 + len(data_block),
             len(fps4_blocks[i]), len(fps4_blocks[i])))
         data_block.extend(fps4_blocks[i])
-    header_block.extend(struct.pack(">3i".format(e), -1, 0, 0)) # Padding
+    header_block.extend(struct.pack(">3i", -1, 0, 0)) # Padding
     header_block.extend(shell_name.encode('utf-8') + b'\x00')
     while len(header_block) < 0x80:
         header_block.extend(b'\x00')
     return (header_block + data_block)
 
-def process_mdl (mdl_file, overwrite = False, write_raw_buffers = True, write_binary_gltf = True):
+# interactive = False never waits for input:  existing files are skipped unless overwrite is True, and when several
+# skeletons match, skeleton_rules (see read_skeleton_rules()) or else the first match is used.
+def process_mdl (mdl_file, overwrite = False, write_raw_buffers = True, write_binary_gltf = True,
+        interactive = True, skeleton_rules = None):
     print("Processing {}...".format(mdl_file))
-    with open(mdl_file, 'rb') as f:
-        magic = f.read(4)
-        if magic == b'TLZC':
-            unc_data = decompress_tlzc(f)
-        elif magic == b'FPS4':
-            f.seek(0)
-            unc_data = f.read()
-    with io.BytesIO(unc_data) as f:
-        set_endianness('<') # Figure out later how to determine this
+    # Models inside an .svo archive use the BASEBONES.DAT from the same archive, unless there is a loose one
+    svo_file, entry_name = split_svo_path(mdl_file)
+    basebones_file = 'BASEBONES.DAT'
+    if not entry_name == '' and not os.path.exists(basebones_file) and svo_path_exists(svo_file + ':BASEBONES.DAT'):
+        basebones_file = svo_file + ':BASEBONES.DAT'
+    with open_mdl_data(mdl_file) as f:
+        codec = byte_order_codecs['<'] # Figure out later how to determine this
         magic = f.read(4)
         if magic == b'FPS4':
-            header = struct.unpack(">3I2H2I".format(e), f.read(24)) # num_entries, unk, len_header, entry_stride, unk * 3
-            toc = []
-            for i in range(header[0]): # entry_stride should be 0x10
-                toc.append(struct.unpack(">3I".format(e), f.read(12))) # offset, padded length, true length
-            start_offset = toc[0][0]
-            base_name = read_string(f, f.tell())
+            fps4 = FPS4Archive(f)
+            base_name = fps4.name
             # Model is the first file
-            f.seek(start_offset)
-            magic_1 = f.read(4)
-            if magic_1 == b'FPS4':
-                header_1 = struct.unpack(">3I2H2I".format(e), f.read(24))
-                toc_1 = []
-                for i in range(header_1[0]): # entry_stride should be 0x10
-                    toc_entry = struct.unpack(">4I".format(e), f.read(16)) # offset, padded length, true length, name offset
-                    toc_name = read_string(f, start_offset + toc_entry[3])
-                    toc_1.append({'name': toc_name, 'offset': toc_entry[0] + start_offset,
-                        'padded_size': toc_entry[2], 'true_size': toc_entry[2]})
-                model_dir = {}
-                for i in range(len(toc_1)):
-                    if toc_1[i]['name'] in model_dir:
-                        model_dir[toc_1[i]['name']].append(i)
-                    else:
-                        model_dir[toc_1[i]['name']] = [i]
-                if 'FPS4' in model_dir:
-                    del(model_dir['FPS4']) # The final entry is padding
+            model_archive = fps4.open(0)
+            if model_archive is not None:
+                toc_1 = model_archive.entries
+                model_dir = model_archive.by_name
                 skel_struct, meshes, bone_palettes, vgmaps, mesh_blocks_info, material_struct, tex_data = [], [], [], [], [], [], []
                 skel_struct_ii, meshes_ii, bone_palette_ids_ii, vgmaps_ii, mesh_blocks_info_ii, material_struct_ii, tex_data_ii = {}, {}, {}, {}, {}, {}, {}
+                skel_ids = set()
                 for model in model_dir:
-                    new_skel_struct = read_skel_section(f, toc_1[model_dir[model][3]]['offset'])
+                    new_skel_struct = read_skel_section(f, toc_1[model_dir[model][3]]['offset'], codec)
                     # Prevent addition of repeated bones - although in my experiments probably not necessary
-                    unique_skel = [x for x in new_skel_struct if not x['id'] in [y['id'] for y in skel_struct]]
+                    unique_skel = [x for x in new_skel_struct if not x['id'] in skel_ids]
                     skel_struct.extend(unique_skel) # At this point the children lists are garbage
+                    skel_ids.update([x['id'] for x in unique_skel])
                     meshes_i, bone_palette_ids_i, mesh_blocks_info_i = read_mesh_section (f,
-                        toc_1[model_dir[model][6]]['offset'], toc_1[model_dir[model][7]]['offset'])
-                    material_struct_i = read_material_section (f, toc_1[model_dir[model][4]]['offset'])
+                        toc_1[model_dir[model][6]]['offset'], toc_1[model_dir[model][7]]['offset'], codec)
+                    material_struct_i = read_material_section (f, toc_1[model_dir[model][4]]['offset'], codec)
                     tex_data_i = read_texture_section(f, toc_1[model_dir[model][8]]['offset'],
                         toc_1[model_dir[model][9]]['offset'])
                     mesh_blocks_info_i = material_id_to_index(mesh_blocks_info_i, material_struct_i, len(material_struct))
@@ -887,12 +1020,14 @@ def process_mdl (mdl_file, overwrite = False, write_raw_buffers = True, write_bi
                     material_struct_ii[model] = material_struct_i
                     tex_data_ii[model] = tex_data_i
                 bone_palette_ids = list(set([x for y in bone_palettes for x in y]))
-                skel_struct, primary_skel_struct = find_and_add_external_skeleton (skel_struct, bone_palette_ids, base_name)
+                skel_struct, primary_skel_struct = find_and_add_external_skeleton (skel_struct, bone_palette_ids,
+                    base_name, basebones_file, interactive, skeleton_rules)
                 model_list = [model for model in model_dir]
+                skeleton = make_skeleton(skel_struct)
+                skel_index = skeleton['id_index']
                 for i in range(len(bone_palettes)):
                     vgmap = {'bone_{}'.format(bone_palettes[i][j]):j for j in range(len(bone_palettes[i]))}
-                    if all([y in [x['id'] for x in skel_struct] for y in bone_palettes[i]]):
-                        skel_index = {skel_struct[j]['id']:j for j in range(len(skel_struct))}
+                    if all([y in skel_index for y in bone_palettes[i]]):
                         vgmap = {skel_struct[skel_index[bone_palettes[i][j]]]['name']:j for j in range(len(bone_palettes[i]))}
                     vgmaps.append(vgmap)
                     vgmaps_ii[model_list[i]] = vgmap
@@ -902,18 +1037,18 @@ def process_mdl (mdl_file, overwrite = False, write_raw_buffers = True, write_bi
                             os.mkdir(base_name)
                         write_struct_to_json(primary_skel_struct, base_name + '/primary_skeleton_info')
                         tail_fps4_blocks = []
-                        for i in range(1, len(toc) - 1):
-                            f.seek(toc[i][0])
-                            tail_fps4_blocks.append(bytearray(f.read(toc[i][1])))
+                        for i in range(1, len(fps4)):
+                            tail_fps4_blocks.append(bytearray(fps4.read(i, padded = True)))
                         tail_fps4 = write_fps4_shell_type (tail_fps4_blocks, shell_name = base_name)
                         open(base_name + '/model_tail_blocks.fps4', 'wb').write(tail_fps4)
                         model_base_name = base_name + '/' + os.path.basename(model)
                         vgmap = {'bone_{}'.format(bone_palette_ids_ii[model][j]):j for j in range(len(bone_palette_ids_ii[model]))}
-                        if all([y in [x['id'] for x in skel_struct] for y in bone_palette_ids_ii[model]]):
-                            skel_index = {skel_struct[j]['id']:j for j in range(len(skel_struct))}
+                        if all([y in skel_index for y in bone_palette_ids_ii[model]]):
                             vgmap = {skel_struct[skel_index[bone_palette_ids_ii[model][j]]]['name']:j for j in range(len(bone_palette_ids_ii[model]))}
                         if os.path.exists(model_base_name) and (os.path.isdir(model_base_name)) and (overwrite == False):
-                            if str(input("Existing raw buffer folders found! Overwrite? (y/N) ")).lower()[0:1] == 'y':
+                            if interactive == False:
+                                print("{} exists, skipping raw buffers.".format(model_base_name))
+                            elif str(input("Existing raw buffer folders found! Overwrite? (y/N) ")).lower()[0:1] == 'y':
                                 overwrite = True
                         if (overwrite == True) or not os.path.exists(model_base_name):
                             if not os.path.exists(model_base_name):
@@ -937,14 +1072,13 @@ def process_mdl (mdl_file, overwrite = False, write_raw_buffers = True, write_bi
                             write_struct_to_json(bonemap, model_base_name + '/bonemap')
                             for i in range(len(tex_data_ii[model])):
                                 f.seek(tex_data_ii[model][i]['offset'])
-                                size, = struct.unpack(">I".format(e), f.read(4)) # Big Endian
+                                size, = f.unpack(">I") # Big Endian
                                 tex_rawdata = f.read(size)
                                 tex_ext = 'dds' if tex_rawdata[0:4] == b'DDS ' else 'bntx' if tex_rawdata[0:4] == b'BNTX' else 'bin'
                                 open('{}/{}.{}'.format(model_base_name, tex_data_ii[model][i]['name'], tex_ext), 'wb').write(tex_rawdata)
                             fps4_struct = []
                             for i in range(len(model_dir[model])):
-                                f.seek(toc_1[model_dir[model][i]]['offset'])
-                                fps4_struct.append({'name':model, 'data': f.read(toc_1[model_dir[model][i]]['padded_size'])})
+                                fps4_struct.append({'name':model, 'data': model_archive.read(model_dir[model][i])})
                             model_fps4 = write_fps4_with_names (fps4_struct)
                             open('{0}/zz_base_model.bin'.format(model_base_name), 'wb').write(model_fps4)
                 if not os.path.exists('textures'):
@@ -952,7 +1086,7 @@ def process_mdl (mdl_file, overwrite = False, write_raw_buffers = True, write_bi
                 has_non_dds_textures = False
                 for i in range(len(tex_data)): # A little repetitive, but these are for the glTF
                     f.seek(tex_data[i]['offset'])
-                    size, = struct.unpack(">I".format(e), f.read(4)) # Big Endian
+                    size, = f.unpack(">I") # Big Endian
                     tex_rawdata = f.read(size)
                     tex_ext = 'dds' if tex_rawdata[0:4] == b'DDS ' else 'bntx' if tex_rawdata[0:4] == b'BNTX' else 'bin'
                     if not tex_ext == 'dds':
@@ -961,8 +1095,8 @@ def process_mdl (mdl_file, overwrite = False, write_raw_buffers = True, write_bi
                     open('textures/{}.{}'.format(tex_data[i]['name'], tex_ext), 'wb').write(tex_rawdata)
                 if has_non_dds_textures == True:
                     print("Warning! Textures are not in DDS format; they will need to be converted to DDS for use with the glTF model.")
-            write_gltf(base_name, skel_struct, vgmaps, mesh_blocks_info, meshes, material_struct,\
-                overwrite = overwrite, write_binary_gltf = write_binary_gltf)
+            write_gltf(base_name, skeleton, vgmaps, mesh_blocks_info, meshes, material_struct,\
+                overwrite = overwrite, write_binary_gltf = write_binary_gltf, interactive = interactive)
     return True
 
 if __name__ == "__main__":
@@ -978,11 +1112,22 @@ if __name__ == "__main__":
         parser.add_argument('-t', '--textformat', help="Write gltf instead of glb", action="store_false")
         parser.add_argument('-s', '--skiprawbuffers', help="Do not write fmt/ib/vb/vgmap files in addition to glb", action="store_false")
         parser.add_argument('-o', '--overwrite', help="Overwrite existing files", action="store_true")
-        parser.add_argument('mdl_file', help="Name of model file to process.")
+        parser.add_argument('-b', '--batch', help="Never wait for input (skip existing files unless -o is given)", action="store_false")
+        parser.add_argument('-r', '--rules', help="JSON file of model name patterns to skeletons, used when several skeletons match")
+        parser.add_argument('mdl_file', help="Name of model file to process, or an .svo file to process every model inside it.")
         args = parser.parse_args()
-        if os.path.exists(args.mdl_file) and args.mdl_file[-4:].upper() == '.DAT':
+        skeleton_rules = read_skeleton_rules(args.rules) if args.rules is not None else None
+        if os.path.isfile(args.mdl_file) and args.mdl_file[-4:].lower() == '.svo':
+            mdl_files = [args.mdl_file + ':' + x['name'] for x in read_svo_toc(args.mdl_file)
+                if x['name'][-4:].upper() == '.DAT' and not x['name'] == 'BASEBONES.DAT']
+            for mdl_file in mdl_files:
+                process_mdl(mdl_file, overwrite = args.overwrite, \
+                    write_raw_buffers = args.skiprawbuffers, write_binary_gltf = args.textformat, \
+                    interactive = args.batch, skeleton_rules = skeleton_rules)
+        elif svo_path_exists(args.mdl_file) and args.mdl_file[-4:].upper() == '.DAT':
             process_mdl(args.mdl_file, overwrite = args.overwrite, \
-                write_raw_buffers = args.skiprawbuffers, write_binary_gltf = args.textformat)
+                write_raw_buffers = args.skiprawbuffers, write_binary_gltf = args.textformat, \
+                interactive = args.batch, skeleton_rules = skeleton_rules)
     else:
         mdl_files = [x for x in glob.glob('*.DAT', recursive=True) if not x == 'BASEBONES.DAT']
         for mdl_file in mdl_files:
@@ -6,26 +6,77 @@
 # For command line options, run:
 # /path/to/python3 vesperia_extract_svo.py --help
 #
+# Requires lib_fps4.py, put in the same directory
+#
 # GitHub eArmada8/vesperia_model_tool
 
-import struct, glob, os, sys
+try:
+    import concurrent.futures, fnmatch, re, json, glob, os, sys
+    from lib_fps4 import *
+except ModuleNotFoundError as e:
+    print("Python module missing! {}".format(e.msg))
+    if sys.stdin.isatty():
+        input("Press Enter to abort.")
+    raise
+
+# Glob patterns ignore case like file names on Windows, regular expressions are used as written
+def filter_svo_toc (toc, name_filters = [], regex_filters = []):
+    if len(name_filters) == 0 and len(regex_filters) == 0:
+        return(toc)
+    name_filters = [x.upper() for x in name_filters]
+    regex_filters = [re.compile(x) for x in regex_filters]
+    return([x for x in toc if any([fnmatch.fnmatchcase(x['name'].upper(), y) for y in name_filters])
+        or any([y.search(x['name']) for y in regex_filters])])
+
+def list_svo (svo_file, name_filters = [], regex_filters = [], write_json = False):
+    toc = filter_svo_toc(read_svo_toc(svo_file), name_filters, regex_filters)
+    if write_json == True:
+        print(json.dumps(toc, indent=4))
+    else:
+        print("{0}: {1} entries".format(svo_file, len(toc)))
+        for entry in toc:
+            print("{0:<40}{1:>12}{2:>12}".format(entry['name'], entry['offset'], entry['true_size']))
+    return
+
+def copy_file_window (src_filename, offset, size, dst_filename, chunk_size = 0x100000):
+    with open(src_filename, 'rb') as f_in, open(dst_filename, 'wb') as f_out:
+        # Let the kernel copy the data directly if possible, without passing it through python
+        for kernel_copy in ['copy_file_range', 'sendfile']:
+            if hasattr(os, kernel_copy):
+                try:
+                    while size > 0:
+                        if kernel_copy == 'copy_file_range':
+                            copied = os.copy_file_range(f_in.fileno(), f_out.fileno(), size, offset)
+                        else:
+                            copied = os.sendfile(f_out.fileno(), f_in.fileno(), offset, size)
+                        if copied == 0:
+                            break
+                        offset += copied
+                        size -= copied
+                    return
+                except OSError: # e.g. not supported between these file systems, try the next method
+                    pass
+        # Copy in bounded chunks through a reusable buffer
+        f_in.seek(offset)
+        buffer = memoryview(bytearray(min(chunk_size, size)))
+        while size > 0:
+            length = f_in.readinto(buffer[:min(chunk_size, size)])
+            if length == 0:
+                break
+            f_out.write(buffer[:length])
+            size -= length
+    return
 
-def extract_svo (svo_file):
-    with open(svo_file, 'rb') as f:
-        magic = f.read(4)
-        if magic == b'FPS4':
-            header = struct.unpack(">3I2H2I", f.read(24))
-            toc = []
-            for i in range(header[0] - 1): # Final entry is padding
-                toc_entry = struct.unpack(">3I", f.read(12)) # offset, padded length, true length
-                toc_name = f.read(0x20).rstrip(b'\x00').decode('utf-8')
-                toc.append({'name': toc_name, 'offset': toc_entry[0],
-                    'padded_size': toc_entry[2], 'true_size': toc_entry[2]})
-            if not os.path.exists(svo_file[:-4]):
-                os.mkdir(svo_file[:-4])
-            for i in range(len(toc)):
-                f.seek(toc[i]['offset'] * 0x80)
-                open(svo_file[:-4] + '/' + toc[i]['name'], 'wb').write(f.read(toc[i]['true_size']))
+def extract_svo (svo_file, num_workers = None, name_filters = [], regex_filters = []):
+    toc = filter_svo_toc(read_svo_toc(svo_file), name_filters, regex_filters)
+    if len(toc) > 0:
+        if not os.path.exists(svo_file[:-4]):
+            os.mkdir(svo_file[:-4])
+        # Every worker opens its own handles, so entries are copied independently of each other
+        with concurrent.futures.ThreadPoolExecutor(max_workers = num_workers) as executor:
+            list(executor.map(lambda x: copy_file_window(svo_file, x['offset'], x['true_size'],
+                svo_file[:-4] + '/' + x['name']), toc))
+    return
 
 if __name__ == "__main__":
     # Set current directory
@@ -37,10 +88,20 @@ if __name__ == "__main__":
     if len(sys.argv) > 1:
         import argparse
         parser = argparse.ArgumentParser()
+        parser.add_argument('-j', '--jobs', help="Number of entries to extract at the same time (default: automatic)", type=int)
+        parser.add_argument('-f', '--filter', help="Only use entries matching this glob pattern, e.g. \"*_C000.DAT\" (can be repeated)",
+            action="append", default=[])
+        parser.add_argument('-r', '--regex', help="Only use entries matching this regular expression (can be repeated)",
+            action="append", default=[])
+        parser.add_argument('-l', '--list', help="List the entries instead of extracting them", action="store_true")
+        parser.add_argument('--json', help="List the entries as JSON (implies --list)", action="store_true")
         parser.add_argument('svo_file', help="Name of svo file to extract.")
         args = parser.parse_args()
         if os.path.exists(args.svo_file) and args.svo_file[-4:] == '.svo':
-            extract_svo(args.svo_file)
+            if args.list or args.json:
+                list_svo(args.svo_file, name_filters = args.filter, regex_filters = args.regex, write_json = args.json)
+            else:
+                extract_svo(args.svo_file, num_workers = args.jobs, name_filters = args.filter, regex_filters = args.regex)
     else:
         svo_files = glob.glob('*.svo')
         for svo_file in svo_files:
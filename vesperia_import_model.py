@@ -7,112 +7,126 @@
 # For command line options, run:
 # /path/to/python3 vesperia_import_model.py --help
 #
-# Requires pyffi_tstrip module and lib_fmtibvb.py, put in the same directory
+# Requires pyffi_tstrip module, lib_fmtibvb.py, lib_fps4.py and lib_tristrip.py, put in the same directory
 #
 # GitHub eArmada8/vesperia_model_tool
 
 try:
-    import struct, json, io, math, shutil, zlib, glob, os, sys
+    import sys, struct, json, numpy, io, shutil, zlib, lzma, glob, os, concurrent.futures
     from lib_fmtibvb import *
     from vesperia_export_model import *
     from pyffi_tstrip.tristrip import *
+    from lib_tristrip import *
 except ModuleNotFoundError as e:
     print("Python module missing! {}".format(e.msg))
-    input("Press Enter to abort.")
+    if sys.stdin.isatty():
+        input("Press Enter to abort.")
     raise
 
 # Global variable, do not edit
-e = '<'
 addr_size = 4
 
-def set_endianness (endianness):
-    global e
-    if endianness in ['<', '>']:
-        e = endianness
-    return
+def stripify_pyffi (triangles):
+    return(numpy.array(stripify(ib_to_legacy(triangles), stitchstrips = True)[0], dtype = numpy.int64))
+
+# Triangle stripifiers, each takes (N,3) triangles and returns a single stitched strip
+stripifiers = {'greedy': stripify_greedy, 'pyffi': stripify_pyffi}
 
-def write_offset (header_size, header_block, data_block):
+def write_offset (header_size, header_block, data_block, codec = byte_order_codecs['<']):
     offset = header_size - len(header_block) + len(data_block)
-    header_block.extend(struct.pack("{}{}".format(e, {4: "I", 8: "Q"}[addr_size]), offset))
+    header_block.extend(codec[{4: "I", 8: "Q"}[addr_size]].pack(offset))
     return
 
-def compress_tlzc (unc_data):
-    cmp_data = zlib.compress(unc_data)
-    tlzc_data = bytearray(b'TLZC')
-    tlzc_data.extend(struct.pack("<5I", 0x0201, len(cmp_data) + 0x18, len(unc_data), 0, 0))
-    tlzc_data.extend(cmp_data)
-    return(tlzc_data)
+def compress_tlzc (unc_data, mode = 2, preset = 6): # Mode 2 (zlib) and 4 (chunked LZMA)
+    if mode == 4:
+        lc, lp, pb = 3, 0, 2
+        filters = [{"id": lzma.FILTER_LZMA1, "preset": preset, "dict_size": 0x10000, "lc": lc, "lp": lp, "pb": pb}]
+        unc_view = memoryview(unc_data)
+        def compress_lzma_stream (unc_offset):
+            unc_chunk = unc_view[unc_offset:unc_offset + 0x10000]
+            cmp_chunk = lzma.compress(unc_chunk, format = lzma.FORMAT_RAW, filters = filters)
+            # Stream sizes are 16-bit, chunks that do not shrink are stored as-is with a size of zero
+            if len(cmp_chunk) < len(unc_chunk):
+                return(len(cmp_chunk), cmp_chunk)
+            else:
+                return(0, unc_chunk)
+        # Every 64 KiB chunk is an independent stream; lzma releases the GIL so threads use all cores
+        with concurrent.futures.ThreadPoolExecutor() as executor:
+            streams = list(executor.map(compress_lzma_stream, range(0, len(unc_data), 0x10000)))
+        cmp_data = bytearray(struct.pack("<BI", (pb * 5 + lp) * 9 + lc, 0x10000))
+        cmp_data.extend(struct.pack("<{}H".format(len(streams)), *[x[0] for x in streams]))
+        for stream in streams:
+            cmp_data.extend(stream[1])
+        unc_view.release()
+        tlzc_data = bytearray(b'TLZC')
+        tlzc_data.extend(struct.pack("<5I", 0x0401, len(cmp_data) + 0x18, len(unc_data), 0, 0))
+        tlzc_data.extend(cmp_data)
+        return(tlzc_data)
+    else:
+        cmp_data = zlib.compress(unc_data)
+        tlzc_data = bytearray(b'TLZC')
+        tlzc_data.extend(struct.pack("<5I", 0x0201, len(cmp_data) + 0x18, len(unc_data), 0, 0))
+        tlzc_data.extend(cmp_data)
+        return(tlzc_data)
 
 def read_fps4_with_names (fps4_filename):
     fps4_struct = []
-    with open(fps4_filename, 'rb') as f:
+    with open_mdl_data(fps4_filename) as f:
         magic = f.read(4)
         if magic == b'FPS4':
-            header = struct.unpack(">3I2H2I".format(e), f.read(24))
-            toc = []
-            for i in range(header[0]): # entry_stride should be 0x10
-                toc_entry = struct.unpack(">4I".format(e), f.read(16)) # offset, padded length, true length, name offset
-                toc_name = read_string(f, toc_entry[3])
-                toc.append({'name': toc_name, 'offset': toc_entry[0],
-                    'padded_size': toc_entry[2], 'true_size': toc_entry[2]})
-            for i in range(len(toc) - 1):
-                f.seek(toc[i]['offset'])
-                fps4_struct.append({'name': toc[i]['name'], 'data': f.read(toc[i]['padded_size'])})
+            fps4 = FPS4Archive(f)
+            for i in range(len(fps4)):
+                fps4_struct.append({'name': fps4.entries[i]['name'], 'data': fps4.read(i)})
     return(fps4_struct)
 
 def read_fps4_shell_type (fps4_filename):
     data_blocks = []
-    with open(fps4_filename, 'rb') as f:
+    with open_mdl_data(fps4_filename) as f:
         magic = f.read(4)
         if magic == b'FPS4':
-            header = struct.unpack(">3I2H2I".format(e), f.read(24))
-            toc = []
-            for i in range(header[0]): # entry_stride should be 0x10
-                toc.append(struct.unpack(">3I".format(e), f.read(12))) # offset, padded length, true length
-            start_offset = toc[0][0]
-            base_name = read_string(f, f.tell())
-            for i in range(len(toc) - 1):
-                f.seek(toc[i][0])
-                data_blocks.append(bytearray(f.read(toc[i][1])))
+            fps4 = FPS4Archive(f)
+            for i in range(len(fps4)):
+                data_blocks.append(bytearray(fps4.read(i, padded = True)))
     return(data_blocks)
 
 #Materials
-def create_section_4 (material_struct):
+def create_section_4 (material_struct, codec = byte_order_codecs['<']):
     num_mats = len(material_struct)
     num_tex = sum([len(x['textures']) for x in material_struct])
     header_sz = 20 + (num_mats * 64) + (num_tex * 40)
     header_block = bytearray()
     name_data_block = bytearray()
-    header_block.extend(struct.pack("{}5I".format(e), 0x30000, 0, 0x10, num_mats, num_tex))
+    header_block.extend(codec['5I'].pack(0x30000, 0, 0x10, num_mats, num_tex))
     for i in range(num_mats):
-        header_block.extend(struct.pack("{}2i".format(e), len(material_struct[i]['textures']),
+        header_block.extend(codec['2i'].pack(len(material_struct[i]['textures']),
             material_struct[i]['internal_id']))
-        header_block.extend(struct.pack("{}if4i".format(e), *material_struct[i]['unk_parameters']['set_0']['base']))
+        header_block.extend(codec['if4i'].pack(*material_struct[i]['unk_parameters']['set_0']['base']))
         for j in range(len(material_struct[i]['textures'])):
-            header_block.extend(struct.pack("{}2i".format(e), *material_struct[i]['unk_parameters']['set_0']['tex'][j]))
+            header_block.extend(codec['2i'].pack(*material_struct[i]['unk_parameters']['set_0']['tex'][j]))
     for i in range(num_mats):
-        header_block.extend(struct.pack("{}I".format(e), material_struct[i]['unk_parameters']['set_1']['base'][0]))
-        write_offset(header_sz, header_block, name_data_block)
+        header_block.extend(codec['I'].pack(material_struct[i]['unk_parameters']['set_1']['base'][0]))
+        write_offset(header_sz, header_block, name_data_block, codec)
         name_data_block.extend(material_struct[i]['name'].encode('utf-8') + b'\x00')
-        write_offset(header_sz, header_block, name_data_block)
+        write_offset(header_sz, header_block, name_data_block, codec)
         name_data_block.extend(b'\x00')
-        header_block.extend(struct.pack("{}I".format(e), material_struct[i]['unk_parameters']['set_1']['base'][1]))
+        header_block.extend(codec['I'].pack(material_struct[i]['unk_parameters']['set_1']['base'][1]))
         for j in range(len(material_struct[i]['textures'])):
-            write_offset(header_sz, header_block, name_data_block)
+            write_offset(header_sz, header_block, name_data_block, codec)
             name_data_block.extend(material_struct[i]['textures'][j].encode('utf-8') + b'\x00')
-            header_block.extend(struct.pack("{}I".format(e), material_struct[i]['unk_parameters']['set_1']['tex'][j]))
+            header_block.extend(codec['I'].pack(material_struct[i]['unk_parameters']['set_1']['tex'][j]))
     for i in range(num_mats):
-        header_block.extend(struct.pack("{}4f".format(e), *material_struct[i]['unk_parameters']['set_2']['base_floats']))
+        header_block.extend(codec['4f'].pack(*material_struct[i]['unk_parameters']['set_2']['base_floats']))
         for j in range(len(material_struct[i]['textures'])):
-            header_block.extend(struct.pack("{}6f".format(e), *material_struct[i]['unk_parameters']['set_2']['tex_floats'][j]))
+            header_block.extend(codec['6f'].pack(*material_struct[i]['unk_parameters']['set_2']['tex_floats'][j]))
     sec_4_block = bytearray(header_block + name_data_block)
     while len(sec_4_block) % 0x10:
         sec_4_block.extend(b'\x00')
-    sec_4_block[4:8] = struct.pack("{}I".format(e), len(sec_4_block))
+    sec_4_block[4:8] = codec['I'].pack(len(sec_4_block))
     return (sec_4_block)
 
 #Meshes
-def create_section_67 (model_base_name, mesh_blocks_info, bone_palette_ids, material_struct):
+def create_section_67 (model_base_name, mesh_blocks_info, bone_palette_ids, material_struct, codec = byte_order_codecs['<'],
+        stripifier = 'greedy'):
     material_dict = {material_struct[i]['name']:material_struct[i]['internal_id'] for i in range(len(material_struct))}
     # Generate mesh blocks first (vertices, indices, uv coordinates)
     base_num_verts, total_verts, total_idxs = [], [], []
@@ -145,11 +159,9 @@ def create_section_67 (model_base_name, mesh_blocks_info, bone_palette_ids, mate
             input("Press Enter to quit.")
             raise
             #pass
-        x0,x1 = max([x[0] for x in vb[0]['Buffer']]), min([x[0] for x in vb[0]['Buffer']])
-        y0,y1 = max([x[1] for x in vb[0]['Buffer']]), min([x[1] for x in vb[0]['Buffer']])
-        z0,z1 = max([x[2] for x in vb[0]['Buffer']]), min([x[2] for x in vb[0]['Buffer']])
-        mesh_midpoint = ((x0+x1)/2, (y0+y1)/2, (z0+z1)/2)
-        bounding_sphere_radius = max([math.dist(x, mesh_midpoint) for x in vb[0]['Buffer']])
+        position = vb[0]['Buffer'][:,0:3]
+        mesh_midpoint = tuple(((position.max(axis = 0) + position.min(axis = 0)) / 2).tolist())
+        bounding_sphere_radius = float(numpy.sqrt(((position - mesh_midpoint) ** 2).sum(axis = 1)).max())
         mesh_midpoint_list.append(mesh_midpoint)
         mesh_radii_list.append(bounding_sphere_radius)
         # Standard weighted meshes
@@ -161,37 +173,39 @@ def create_section_67 (model_base_name, mesh_blocks_info, bone_palette_ids, mate
         if mesh_blocks_info[i]["flags"] & 0xF00 == 0x100:
             ib_blocks = [ib]
             vb_blocks = [vb]
-            idx_header_block = bytearray(struct.pack("{}I".format(e), len(ib_blocks)))
+            idx_header_block = bytearray(codec['I'].pack(len(ib_blocks)))
             for j in range(1): # splitting later
                 # Split vertices into weight types
-                vgrp = [4 if not x[3]==0.0 else 3 if not x[2]==0.0 else 2 if not x[1]==0.0 else 1 for x in vb_blocks[j][-2]['Buffer']]
-                v_by_grp = [[l for l, vgrpval in enumerate(vgrp) if vgrpval == k] for k in range(1,5)]
-                new_v_assgn = {}
-                counter = 0
-                for k in range(len(v_by_grp)):
-                    for l in range(len(v_by_grp[k])):
-                        new_v_assgn[v_by_grp[k][l]] = counter
-                        counter += 1
+                weights = vb_blocks[j][-2]['Buffer']
+                vgrp = numpy.where(weights[:,3] != 0.0, 4, numpy.where(weights[:,2] != 0.0, 3,
+                    numpy.where(weights[:,1] != 0.0, 2, 1)))
+                v_by_grp = [numpy.flatnonzero(vgrp == k) for k in range(1,5)]
+                new_v_assgn = numpy.zeros(len(vgrp), dtype = numpy.int64)
+                new_v_assgn[numpy.concatenate(v_by_grp)] = numpy.arange(len(vgrp))
                 if j == 0:
                     base_num_verts.append([len(x) for x in v_by_grp])
                 else:
-                    vert_block.extend(struct.pack("{}4I".format(e), *[len(x) for x in v_by_grp]))
+                    vert_block.extend(codec['4I'].pack(*[len(x) for x in v_by_grp]))
                 for k in range(len(v_by_grp)):
-                    for l in range(len(v_by_grp[k])):
-                        vert_block.extend(struct.pack("{}3f".format(e), *vb_blocks[j][0]['Buffer'][v_by_grp[k][l]])) # Vertices
-                        vert_block.extend(struct.pack("{}3f".format(e), *vb_blocks[j][1]['Buffer'][v_by_grp[k][l]])) # Normals
-                        vert_block.extend(struct.pack("{}4B".format(e), *vb_blocks[j][-1]['Buffer'][v_by_grp[k][l]][::-1])) # Blend indices
-                        if k > 0:
-                            vert_block.extend(struct.pack("{}{}f".format(e, k),
-                                *vb_blocks[j][-2]['Buffer'][v_by_grp[k][l]][:k])) # Blend weights
-                        uv_block.extend(struct.pack("{}i".format(e), -1)) # Padding
-                        for m in range(num_uvs):
-                            uv_block.extend(struct.pack("{}2f".format(e), *vb_blocks[j][2+m]['Buffer'][v_by_grp[k][l]])) # UVs
+                    # Vertices with k+1 weights, the last weight is not stored
+                    verts = numpy.zeros(len(v_by_grp[k]), dtype = [('vert', codec.e+'f4', (3,)),
+                        ('norm', codec.e+'f4', (3,)), ('blend_idx', 'u1', (4,)), ('weights', codec.e+'f4', (k,))])
+                    verts['vert'] = vb_blocks[j][0]['Buffer'][v_by_grp[k]]
+                    verts['norm'] = vb_blocks[j][1]['Buffer'][v_by_grp[k]]
+                    verts['blend_idx'] = vb_blocks[j][-1]['Buffer'][v_by_grp[k]][:,::-1]
+                    verts['weights'] = weights[v_by_grp[k], 0:k]
+                    vert_block.extend(verts.tobytes())
+                    uvs = numpy.zeros(len(v_by_grp[k]), dtype = [('padding', codec.e+'i4'),
+                        ('uv', codec.e+'f4', (num_uvs, 2))])
+                    uvs['padding'] = -1
+                    for m in range(num_uvs):
+                        uvs['uv'][:,m] = vb_blocks[j][2+m]['Buffer'][v_by_grp[k]]
+                    uv_block.extend(uvs.tobytes())
                 total_vert += len(vb_blocks[j][0]['Buffer'])
-                new_ib = [new_v_assgn[x] for x in stripify(ib_blocks[j], stitchstrips = True)[0]]
-                idx_dat_block.extend(struct.pack("{}{}H".format(e, len(new_ib)), *new_ib)) # Triangles
+                new_ib = new_v_assgn[stripifiers[stripifier](ib_blocks[j])]
+                idx_dat_block.extend(new_ib.astype(codec.e+'u2').tobytes()) # Triangles
                 total_idx += len(new_ib)
-                idx_header_block.extend(struct.pack("{}2H".format(e), len(vb_blocks[j][0]['Buffer']), len(new_ib)))
+                idx_header_block.extend(codec['2H'].pack(len(vb_blocks[j][0]['Buffer']), len(new_ib)))
             idx_block = bytearray(idx_header_block + idx_dat_block)
             if len(idx_block) % 4:
                 idx_block += b'\x00' * (4 - (len(idx_block) % 4))
@@ -218,46 +232,45 @@ def create_section_67 (model_base_name, mesh_blocks_info, bone_palette_ids, mate
     uv_data_block = bytearray()
     name_data_block = bytearray()
     for i in range(num_meshes):
-        header_block.extend(struct.pack("{}3f".format(e), *mesh_midpoint_list[i]))
-        header_block.extend(struct.pack("{}f".format(e), mesh_radii_list[i]))
-        header_block.extend(struct.pack("{}4I".format(e), *base_num_verts[i]))
+        header_block.extend(codec['3f'].pack(*mesh_midpoint_list[i]))
+        header_block.extend(codec['f'].pack(mesh_radii_list[i]))
+        header_block.extend(codec['4I'].pack(*base_num_verts[i]))
     for i in range(num_meshes):
-        header_block.extend(struct.pack("{}4f".format(e), *inserted_meshes_info[i]['unk_fltarr']))
+        header_block.extend(codec['4f'].pack(*inserted_meshes_info[i]['unk_fltarr']))
     for i in range(num_meshes):
-        header_block.extend(struct.pack("{}4I".format(e), inserted_meshes_info[i]['flags'],
+        header_block.extend(codec['4I'].pack(inserted_meshes_info[i]['flags'],
             inserted_meshes_info[i]['mesh'], inserted_meshes_info[i]['submesh'], inserted_meshes_info[i]['node']))
-        header_block.extend(struct.pack("{}I".format(e), material_list[i]))
-        header_block.extend(struct.pack("{}I".format(e), len(uv_data_block)))
+        header_block.extend(codec['I'].pack(material_list[i]))
+        header_block.extend(codec['I'].pack(len(uv_data_block)))
         uv_data_block.extend(uv_blocks[i])
-        write_offset(head_sz + vblock_sz, header_block, idx_data_block)
+        write_offset(head_sz + vblock_sz, header_block, idx_data_block, codec)
         idx_data_block.extend(idx_blocks[i])
-        write_offset(head_sz, header_block, vert_data_block)
+        write_offset(head_sz, header_block, vert_data_block, codec)
         vert_data_block.extend(vert_blocks[i])
-        header_block.extend(struct.pack("{}5I".format(e), inserted_meshes_info[i]['uv_stride'],
+        header_block.extend(codec['5I'].pack(inserted_meshes_info[i]['uv_stride'],
             inserted_meshes_info[i]['flags2'], total_verts[i], total_idxs[i], inserted_meshes_info[i]['unk']))
-        write_offset(head_sz + vblock_sz + iblock_sz, header_block, name_data_block)
+        write_offset(head_sz + vblock_sz + iblock_sz, header_block, name_data_block, codec)
         name_data_block.extend(inserted_meshes_info[i]['name'].encode('utf-8') + b'\x00')
-        write_offset(head_sz + vblock_sz + iblock_sz, header_block, name_data_block)
+        write_offset(head_sz + vblock_sz + iblock_sz, header_block, name_data_block, codec)
         name_data_block.extend(b'\x00')
-    header_block.extend(struct.pack("{}{}I".format(e, palette_count), *bone_palette_ids))
+    header_block.extend(numpy.asarray(bone_palette_ids, dtype = codec.e + 'u4').tobytes())
     while len(header_block) % 0x10:
         header_block.extend(b'\x00')
     sec_6_block = bytearray(header_block + vert_data_block + idx_data_block + name_data_block)
     while len(sec_6_block) % 0x10:
         sec_6_block.extend(b'\x00')
-    sec_6_block[4:8] = struct.pack("{}I".format(e), len(sec_6_block))
+    sec_6_block[4:8] = codec['I'].pack(len(sec_6_block))
     while len(uv_data_block) % 0x10:
         uv_data_block.extend(b'\x00')
-    uv_data_block.extend(struct.pack("{}16I".format(e), *[0]*16))
+    uv_data_block.extend(codec['16I'].pack(*[0]*16))
     return (sec_6_block, uv_data_block)
 
 #Textures
 def create_section_89 (model_base_name, tex_names):
-    current_endian = e
-    set_endianness('>') # This section is in big endian (and most of the data is actually wrong)
+    codec = byte_order_codecs['>'] # This section is in big endian (and most of the data is actually wrong)
     sec_9_block = bytearray()
     sec_8_header_sz = (0x18 + (0x1C * len(tex_names)))
-    sec_8_header_block = bytearray(struct.pack("{}6I".format(e), 0x20000, 0, 0x10, len(tex_names), 0, 0))
+    sec_8_header_block = bytearray(codec['6I'].pack(0x20000, 0, 0x10, len(tex_names), 0, 0))
     sec_8_name_block = bytearray()
     for i in range(len(tex_names)):
         with open(model_base_name + '/' + tex_names[i], 'rb') as f:
@@ -279,60 +292,33 @@ def create_section_89 (model_base_name, tex_names):
                         header['dwMipMapCount'], = struct.unpack("<H", brti_header[0x16:0x18])
                         header['dwWidth'], = struct.unpack("<I", brti_header[0x24:0x28])
                         header['dwHeight'], = struct.unpack("<I", brti_header[0x28:0x2C])
-            sec_8_header_block.extend(struct.pack("{}4I".format(e), header['dwWidth'], header['dwHeight'],
+            sec_8_header_block.extend(codec['4I'].pack(header['dwWidth'], header['dwHeight'],
                 header['dwMipMapCount'], 0x8804aae4)) # The last hex value is wrong, even in native files
-            write_offset(sec_8_header_sz, sec_8_header_block, sec_8_name_block)
+            write_offset(sec_8_header_sz, sec_8_header_block, sec_8_name_block, codec)
             sec_8_name_block.extend(os.path.splitext(tex_names[i])[0].encode('utf-8') + b'\x00')
-            sec_8_header_block.extend(struct.pack("{}2I".format(e), len(sec_9_block), 0))
-            sec_9_block.extend(struct.pack("{}I".format(e), len(img_dat)))
+            sec_8_header_block.extend(codec['2I'].pack(len(sec_9_block), 0))
+            sec_9_block.extend(codec['I'].pack(len(img_dat)))
             sec_9_block.extend(img_dat)
     sec_8_block = bytearray(sec_8_header_block + sec_8_name_block)
     while len(sec_8_block) % 0x10:
         sec_8_block.extend(b'\x00')
-    sec_8_block[4:8] = struct.pack("{}I".format(e), len(sec_8_block))
+    sec_8_block[4:8] = codec['I'].pack(len(sec_8_block))
     while len(sec_9_block) % 0x10:
         sec_9_block.extend(b'\x00')
-    set_endianness(current_endian) # Restore original endianness
     return (sec_8_block, sec_9_block)
 
-def rebuild_mdl (mdl_file):
+def rebuild_mdl (mdl_file, stripifier = 'greedy'):
     new_model_fps4 = bytearray()
-    with open(mdl_file, 'rb') as f:
-        magic = f.read(4)
-        if magic == b'TLZC':
-            unc_data = decompress_tlzc(f)
-        elif magic == b'FPS4':
-            f.seek(0)
-            unc_data = f.read()
-    with io.BytesIO(unc_data) as f:
-        set_endianness('<') # Figure out later how to determine this
+    with open_mdl_data(mdl_file) as f:
+        codec = byte_order_codecs['<'] # Figure out later how to determine this
         magic = f.read(4)
         if magic == b'FPS4':
-            header = struct.unpack(">3I2H2I".format(e), f.read(24)) # num_entries, unk, len_header, entry_stride, unk * 3
-            toc = []
-            for i in range(header[0]): # entry_stride should be 0x10
-                toc.append(struct.unpack(">3I".format(e), f.read(12))) # offset, padded length, true length
-            start_offset = toc[0][0]
-            base_name = read_string(f, f.tell())
+            fps4 = FPS4Archive(f)
+            base_name = fps4.name
             # Model is the first file
-            f.seek(start_offset)
-            magic_1 = f.read(4)
-            if magic_1 == b'FPS4':
-                header_1 = struct.unpack(">3I2H2I".format(e), f.read(24))
-                toc_1 = []
-                for i in range(header_1[0]): # entry_stride should be 0x10
-                    toc_entry = struct.unpack(">4I".format(e), f.read(16)) # offset, padded length, true length, name offset
-                    toc_name = read_string(f, start_offset + toc_entry[3])
-                    toc_1.append({'name': toc_name, 'offset': toc_entry[0] + start_offset,
-                        'padded_size': toc_entry[2], 'true_size': toc_entry[2]})
-                model_dir = {}
-                for i in range(len(toc_1)):
-                    if toc_1[i]['name'] in model_dir:
-                        model_dir[toc_1[i]['name']].append(i)
-                    else:
-                        model_dir[toc_1[i]['name']] = [i]
-                if 'FPS4' in model_dir:
-                    del(model_dir['FPS4']) # The final entry is padding
+            model_archive = fps4.open(0)
+            if model_archive is not None:
+                model_dir = model_archive.by_name
                 model_skel_struct = read_struct_from_json(base_name + '/primary_skeleton_info.json')\
                     + [x for y in [read_struct_from_json(base_name + '/' + os.path.basename(model)
                     + '/model_skeleton_info.json') for model in model_dir] for x in y]
@@ -345,7 +331,7 @@ def rebuild_mdl (mdl_file):
                         base_model_data_blocks[i]['name'] = model
                     # Build new material section
                     material_struct = read_struct_from_json(model_base_name + "/material_info.json")
-                    sec4 = create_section_4 (material_struct)
+                    sec4 = create_section_4 (material_struct, codec)
                     base_model_data_blocks[4]['data'] = sec4
                     # Build new mesh section
                     mesh_blocks_info = read_struct_from_json(model_base_name + "/mesh_info.json")
@@ -354,7 +340,8 @@ def rebuild_mdl (mdl_file):
                         bone_dict = {x['name']:x['id'] for x in model_skel_struct}
                         bone_palette_ids = [bone_dict[bonemap[i]] if bonemap[i] in bone_dict
                             else int(bonemap[i].replace('bone_','')) for i in range(len(bonemap))]
-                        sec6, sec7 = create_section_67 (model_base_name, mesh_blocks_info, bone_palette_ids, material_struct)
+                        sec6, sec7 = create_section_67 (model_base_name, mesh_blocks_info, bone_palette_ids, material_struct,
+                            codec, stripifier)
                         base_model_data_blocks[6]['data'] = sec6
                         base_model_data_blocks[7]['data'] = sec7
                     else:
@@ -371,10 +358,10 @@ def rebuild_mdl (mdl_file):
                     + tail_fps4_blocks, shell_name = base_name)
     return (new_model_fps4)
 
-def process_mdl(mdl_file):
+def process_mdl(mdl_file, tlzc_mode = 2, lzma_preset = 6, stripifier = 'greedy'):
     print("Processing {}...".format(mdl_file))
-    new_model_fps4 = rebuild_mdl(mdl_file)
-    cmp_model_fps4 = compress_tlzc(new_model_fps4)
+    new_model_fps4 = rebuild_mdl(mdl_file, stripifier)
+    cmp_model_fps4 = compress_tlzc(new_model_fps4, mode = tlzc_mode, preset = lzma_preset)
     # Instead of overwriting backups, it will just tag a number onto the end
     backup_suffix = ''
     if os.path.exists(mdl_file + '.bak' + backup_suffix):
@@ -399,10 +386,16 @@ if __name__ == "__main__":
     if len(sys.argv) > 1:
         import argparse
         parser = argparse.ArgumentParser()
+        parser.add_argument('-l', '--lzma', help="Compress with chunked LZMA (TLZC mode 4) instead of zlib", action="store_true")
+        parser.add_argument('-p', '--preset', help="LZMA compression preset, 0 (fastest) to 9 (smallest), default 6",
+            type=int, choices=range(10), default=6)
+        parser.add_argument('-s', '--stripifier', help="Triangle stripifier, greedy (fast, default) or pyffi (NvTriStrip port)",
+            choices=list(stripifiers.keys()), default='greedy')
         parser.add_argument('mdl_filename', help="Name of model .DAT file to import into (required).")
         args = parser.parse_args()
         if os.path.exists(args.mdl_filename) and args.mdl_filename[-4:].upper() == '.DAT':
-            process_mdl(args.mdl_filename)
+            process_mdl(args.mdl_filename, tlzc_mode = 4 if args.lzma else 2, lzma_preset = args.preset,
+                stripifier = args.stripifier)
     else:
         mdl_filenames = [x for x in glob.glob('*.DAT') if not x == 'BASEBONES.DAT']
         mdl_filenames = [x for x in mdl_filenames if os.path.isdir(x[:-4])]